@@ -1,5 +1,6 @@
 from machine import Pin, SoftI2C, UART
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 import json
 from time import sleep, ticks_ms
@@ -37,7 +38,7 @@ i2c = SoftI2C(scl=SCL_PIN, sda=SDA_PIN)
 
 expander = Expander(i2c)
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -62,19 +63,16 @@ class Puzzle:
     
     
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
         
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(5000, network.check_mqtt_and_reconnect)
+        self.timers.every(1000, self.indicator_led.toggle)
+        
         self.readers = []
         self.readers.append(self.Reader(1, Pin(2, Pin.IN), Pin(4, Pin.IN)))
         self.readers.append(self.Reader(2, Pin(7, Pin.IN), Pin(5, Pin.IN)))
@@ -90,19 +88,11 @@ class Puzzle:
 
         
  
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        if ticks_ms() - self.pong_timer > self.pong_timeout:
-            self.network.check_mqtt_and_reconnect()
-            self.pong_timer = ticks_ms()
-            
+        self.timers.run()
         self.send_status()
         
             
@@ -114,6 +104,9 @@ class Puzzle:
         except ValueError:
             print("not valid JSON")
             return
+
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
     
 
     def puzzle_json_generator(self, status):
@@ -130,6 +123,7 @@ class Puzzle:
             print(f"Updating status {status_json}")
             self.last_status = status_json
             self.network.send_mqtt_json(self.topic, self.last_status )
+            self.network.update_state(self.topic, {"readers": self.last_status})
 
 
 
@@ -142,6 +136,7 @@ while not network.check_mqtt_and_reconnect():
     sleep(0.5)
 
 while True:
+    network.loop_tick()
     try:
         network.check_for_messages()
     except:
@@ -1,6 +1,7 @@
 from machine import Pin, SoftI2C, UART
 
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 
 import json
@@ -27,7 +28,7 @@ with open("config.json") as f:
 
 
 if NETWORK:
-    network = MINetwork()
+    network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
     # load webrepl
@@ -42,36 +43,24 @@ else:
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
         
+        self.timers = TimerWheel()
+        if NETWORK:
+            self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+            self.timers.every(5000, network.check_mqtt_and_reconnect)
+        self.timers.every(1000, self.indicator_led.toggle)
+        
     
  
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
-        if NETWORK:
-            if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-                network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-                self.heartbeat_timer = ticks_ms()
-                
-            if ticks_ms() - self.pong_timer > self.pong_timeout:
-                self.network.check_mqtt_and_reconnect()
-                self.pong_timer = ticks_ms()
-        
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
+        self.timers.run()
             
     def process_message(self, topic, raw_message):
         message = raw_message.decode('utf-8')
@@ -81,6 +70,9 @@ class Puzzle:
         except ValueError:
             print("not valid JSON")
             return
+
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
         
         if "power" in message_json:
             if message_json["power"] is "on":
@@ -97,6 +89,7 @@ if NETWORK:
 while False:
     
     if NETWORK:
+        network.loop_tick()
         try:
             network.check_for_messages()
         except:
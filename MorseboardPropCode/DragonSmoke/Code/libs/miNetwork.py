@@ -1,9 +1,13 @@
 from machine import Pin, SPI, SoftI2C
 import network
-from time import sleep, ticks_ms
+from time import sleep, time, ticks_ms, ticks_diff, ticks_add
 import usocket
-from libs.simple_mqtt import MQTTClient
+import errno
+from libs.simple_mqtt import MQTTClient, MQTTException
+from libs import log
+from libs import spi_tune
 import json
+import gc
 
 
 # Networking class to manage the network connection, including connection to MQTT broker
@@ -16,10 +20,18 @@ class MINetwork:
         unknown = "unknown"
         disconnected = "disconnected"
 
-    def __init__(self, network_type="dhcp"):
+    # states of the mqtt connection, advanced by step_mqtt
+    class States:
+        disconnected = "disconnected"  # waiting for the next attempt
+        connecting = "connecting"  # CONNECT sent, waiting for the CONNACK
+        subscribing = "subscribing"  # resubscribed, waiting for the SUBACK
+        up = "up"
 
-        # SPI connection: pins and settings defined by the W5500 board
-        self.spi = SPI(0, 2_000_000, mosi=Pin(19), miso=Pin(16), sck=Pin(18))
+    def __init__(self, network_type="dhcp", offline_queue_size=8, keepalive=30, lease_file="lease.json", topic_mode="shared"):
+
+        # SPI connection: pins and settings defined by the W5500 board, the
+        # clock as calibrated for this board (see libs/spi_tune.py)
+        self.spi = SPI(0, spi_tune.baudrate("w5500", 2_000_000), mosi=Pin(19), miso=Pin(16), sck=Pin(18))
 
         # Network connection
         self.nic = network.WIZNET5K(self.spi, Pin(17), Pin(20))  # spi,cs,reset pin
@@ -29,6 +41,38 @@ class MINetwork:
 
         self.status = self.Statuses.unknown
 
+        # the last working ifconfig and broker are kept on flash so the
+        # next boot can skip DHCP (see connect_to_network). boot_timings
+        # has how long this boot took to get on the network each way, and
+        # goes out in the heartbeat. A saved lease is used for at most
+        # lease_max_uses boots before one that runs DHCP to renew it, and
+        # not once lease_max_age_s old by the clock.
+        self.lease_file = lease_file
+        self.lease = None
+        self.lease_max_uses = 5
+        self.lease_max_age_s = 86400
+        self.boot_timings = {}
+
+        # broker address cache: what the broker's name last resolved to,
+        # kept here and in the lease file so reconnects don't wait on DNS.
+        # It's looked up again, just before a reconnect, once it's older
+        # than broker_ttl_ms or reconnecting has failed long enough to max
+        # out the backoff - never while the connection is up, as the lookup
+        # blocks.
+        self.broker_ip = None
+        self.broker_resolved = ticks_ms()
+        self.broker_ttl_ms = 600000
+
+        # telemetry reported in the heartbeat (see telemetry). Main loop
+        # iterations are counted by the prop's loop calling loop_tick, and
+        # the loop stats cover the time since the last heartbeat.
+        self.ip = None
+        self.boot_time = ticks_ms()
+        self.mqtt_connects = 0
+        self.loop_count = 0
+        self.loop_worst_ms = 0
+        self.loop_last = self.loop_start = ticks_ms()
+
         self.mqtt_server = None
         self.mqtt_connection = None
         self.mqtt_topic = None
@@ -37,115 +81,735 @@ class MINetwork:
         self.indicator_led = Pin(25, Pin.OUT)
 
         self.subscription_list = {}
+        self.subscription_qos = {}
+        self.subscription_copy = {}
 
-    def connect_to_network(self, connection_timeout=10):
-        self.nic.active(True)
+        # persistent session: the broker keeps our subscriptions and queues
+        # QoS 1 messages while we're away, so a reconnect needn't resubscribe
+        self.persistent_session = False
+        self.session_present = False
+
+        # 4 for MQTT 3.1.1, 5 for MQTT 5 (topic aliases on publish, and
+        # no-local subscriptions so our own messages don't come back to us)
+        self.mqtt_protocol = 4
+
+        # seconds: an idle link is pinged after half of this, and counts as
+        # down after all of it with nothing heard from the broker
+        self.keepalive = keepalive
 
+        # reconnection: attempts are spaced out with exponential backoff
+        # (plus jitter, so a room full of props doesn't retry in step), and
+        # a connecting or subscribing state that doesn't finish within
+        # state_timeout_ms counts as a failed attempt
+        self.mqtt_state = self.States.disconnected
+        self.state_timer = ticks_ms()
+        # when the connection last got somewhere (came up, heard from the
+        # broker - a PINGRESP at least every keepalive - or, while it's down,
+        # made a fresh attempt or backed off), for the watchdog supervisor
+        # to catch a network loop that's stuck. A broker that stays away
+        # isn't stuck: the prop keeps working locally.
+        self.progress_ms = ticks_ms()
+        self.retry_at = ticks_ms()
+        self.backoff_min_ms = 1000
+        self.backoff_max_ms = 30000
+        self.backoff_ms = self.backoff_min_ms
+        # 0-65535, fixed for this board and client id (see _jitter_seed).
+        # Retries and heartbeats are offset by it so a broker restart
+        # doesn't have every prop reconnecting and beating in step.
+        self.jitter = 0
+        # when the connection was lost, and how long the last outage was
+        self.down_since = None
+        self.down_ms = 0
+        self.heartbeat_topic = None
+        self.connect_timeout = 1
+        self.state_timeout_ms = 5000
+        self.resubscribe_pid = None
+
+        # messages that couldn't be sent while the broker was unreachable, in
+        # a ring allocated here at boot. A newer snapshot style message
+        # ({"cards": ...}, {"locations": ...}) replaces the queued older one.
+        self.offline_size = offline_queue_size
+        self.offline_topic = [None] * offline_queue_size
+        self.offline_key = [None] * offline_queue_size
+        self.offline_msg = [None] * offline_queue_size
+        self.offline_head = 0
+        self.offline_count = 0
+        self.offline_dropped = 0
+        self.snapshot_keys = ("cards", "locations", "spiders", "animals", "status", "heartbeat")
+
+        # opt-in per tick coalescing: with coalesce set, json messages (and
+        # heartbeats) are held per topic until flush_tick, which
+        # check_for_messages calls at the start of each loop iteration
+        self.coalesce = False
+        self.tick_topics = []
+        self.tick_msgs = {}
+
+        # retained state: the latest value of each state key a prop has sent
+        # on a topic is kept in one document, published retained to
+        # <topic>/state whenever it changes, so anything subscribing later
+        # gets the prop's current state from the broker straight away
+        self.state_keys = ("cards", "locations", "spiders", "animals", "status", "symbols", "uv_status")
+        self.state_suffix = "/state"
+        self.states = {}
+        self.state_json = {}
+        self.state_unsent = []
+
+        # topics. In "shared" mode (what the Node-RED flows were built on)
+        # a prop takes commands and publishes on the same topic, so it gets
+        # everything it sends back again. "split" takes commands on
+        # <topic>/cmd and publishes its events (and heartbeats and logs) on
+        # <topic>/event, leaving <topic>/state to the retained state.
+        # "compat" is for moving flows over: commands are taken on both
+        # <topic> and <topic>/cmd, and sends still go to <topic>.
+        self.topic_mode = topic_mode
+        self.event_suffix = "/event"
+        # prop topic: the topic its sends actually go to
+        self.publish_topics = {}
+
+    # Bring the network up. If an earlier boot saved its lease (and it
+    # hasn't expired), that ifconfig is tried first and checked by reaching
+    # the broker it used. If that fails we go back to DHCP, which blocks
+    # until it has a lease (up to about 10s). The lease isn't renewed while
+    # the prop runs - that would block the loop just the same - so an
+    # expired one means this boot waits for DHCP instead. With no saved
+    # lease we wait for DHCP.
+    def connect_to_network(self, connection_timeout=10, lease_timeout=1):
         start_time = ticks_ms()
-        while not self.nic.isconnected() and (ticks_ms() - start_time) < (connection_timeout * 1000):
+        self.nic.active(True)
+        self.lease = self._load_lease()
+        if self.lease is not None and self._lease_expired():
+            print("miNetwork: saved lease has expired")
+            self.lease.pop("ifconfig", None)
+
+        if self.lease is not None and "ifconfig" in self.lease:
+            if self._try_lease(start_time, lease_timeout):
+                self.status = self.Statuses.connected
+                self.ip = self.lease["ifconfig"][0]
+                self.boot_timings["cached_ms"] = ticks_diff(ticks_ms(), start_time)
+                self.boot_timings["dhcp_ms"] = self.lease.get("dhcp_ms")
+                print(f"miNetwork: using saved lease {self.lease['ifconfig']} in {self.boot_timings['cached_ms']}ms")
+                lease = dict(self.lease)
+                lease["uses"] = lease.get("uses", 0) + 1
+                self._save_lease(lease)
+                return True
+            print("miNetwork: saved lease didn't work, falling back to DHCP")
+            self.boot_timings["cached_ms"] = None
+            try:
+                self.nic.ifconfig("dhcp")
+            except OSError as e:
+                print(f"miNetwork: DHCP failed {e}")
+                self.status = self.Statuses.disconnected
+                return False
+            self.status = self.Statuses.connected
+            print('IP address :', self.nic.ifconfig())
+            self._dhcp_done(start_time)
+            return True
+
+        while not self.nic.isconnected() and ticks_diff(ticks_ms(), start_time) < connection_timeout * 1000:
             sleep(0.5)
             print(f"attempting connecting ...")
 
         if self.nic.isconnected():
             self.status = self.Statuses.connected
             print('IP address :', self.nic.ifconfig())
-
+            self._dhcp_done(start_time)
+            return True
         else:
             self.status = self.Statuses.disconnected
             return False
 
+    def _try_lease(self, start_time, timeout):
+        self.nic.ifconfig(tuple(self.lease["ifconfig"]))
+        while not self.nic.isconnected():
+            if ticks_diff(ticks_ms(), start_time) > timeout * 1000:
+                return False
+            sleep(0.05)
+        broker = self.lease.get("broker_ip") or self.lease.get("broker")
+        return broker is None or self.reachable(broker, timeout=timeout)
+
+    # The clock only counts if it's been set since the lease was saved: the
+    # Pico's starts again from the same time on every boot
+    def _lease_expired(self):
+        if self.lease.get("uses", 0) >= self.lease_max_uses:
+            return True
+        return time() - self.lease.get("saved", 0) > self.lease_max_age_s
+
+    # Is anything listening at host (or at least answering for it)? A
+    # refused connection counts: the address is on the network.
+    @staticmethod
+    def reachable(host, port=1883, timeout=1):
+        sock = usocket.socket()
+        try:
+            sock.settimeout(timeout)
+            sock.connect(usocket.getaddrinfo(host, port)[0][-1])
+            return True
+        except OSError as e:
+            return e.args[0] == errno.ECONNREFUSED
+        finally:
+            sock.close()
+
+    # DHCP has given us an address: remember it for next boot
+    def _dhcp_done(self, start_time):
+        self.ip = self.nic.ifconfig()[0]
+        self.boot_timings["dhcp_ms"] = ticks_diff(ticks_ms(), start_time)
+        lease = dict(self.lease or {})
+        lease["ifconfig"] = list(self.nic.ifconfig())
+        lease["dhcp_ms"] = self.boot_timings["dhcp_ms"]
+        lease["saved"] = time()
+        lease["uses"] = 0
+        self._save_lease(lease)
+
+    def _load_lease(self):
+        try:
+            with open(self.lease_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_lease(self, lease):
+        try:
+            with open(self.lease_file, "w") as f:
+                json.dump(lease, f)
+            self.lease = lease
+        except OSError as e:
+            print(f"miNetwork: couldn't save lease {e}")
+
     # resolve IP given hostname - this doesn't always work...
     @staticmethod
     def resolve_ip(host):
         return usocket.getaddrinfo(host, 80, 0, usocket.SOCK_STREAM)[0][4][0]
 
+    @staticmethod
+    def is_ip(host):
+        parts = host.split(".")
+        return len(parts) == 4 and all(part.isdigit() for part in parts)
+
+    # The address to connect to the broker at: mqtt_server itself if it's
+    # an IP address, otherwise the cached resolution (looked up now only if
+    # there's nothing cached at all)
+    def broker_address(self):
+        if self.is_ip(self.mqtt_server):
+            return self.mqtt_server
+        if self.broker_ip is None:
+            lease = self.lease or {}
+            if lease.get("broker") == self.mqtt_server and lease.get("broker_ip"):
+                self.broker_ip = lease["broker_ip"]
+                # from an earlier boot, so due a refresh
+                self.broker_resolved = ticks_add(ticks_ms(), -self.broker_ttl_ms)
+            else:
+                self.resolve_broker()
+        return self.broker_ip
+
+    # Before a connection attempt: check a stale cached address, or one
+    # that keeps failing, hasn't moved
+    def _refresh_broker(self):
+        if self.broker_ip is None or self.is_ip(self.mqtt_server):
+            return
+        if self.backoff_ms >= self.backoff_max_ms or ticks_diff(ticks_ms(), self.broker_resolved) > self.broker_ttl_ms:
+            self.resolve_broker()
+
+    # Look the broker up again, keeping the old address if that fails
+    def resolve_broker(self):
+        try:
+            ip = self.resolve_ip(self.mqtt_server)
+        except Exception as e:
+            print(f"miNetwork: couldn't resolve {self.mqtt_server} {e}")
+            return False
+        self.broker_resolved = ticks_ms()
+        if ip != self.broker_ip:
+            print(f"miNetwork: {self.mqtt_server} is at {ip}")
+            self.broker_ip = ip
+            self._save_broker()
+        return True
+
+    def _save_broker(self):
+        lease = dict(self.lease or {})
+        if lease.get("broker") != self.mqtt_server or lease.get("broker_ip") != self.broker_ip:
+            lease["broker"] = self.mqtt_server
+            lease["broker_ip"] = self.broker_ip
+            self._save_lease(lease)
+
     # Check the status of the network connection
     def check_status_network_connection(self):
         return self.nic.isconnected()
     
-    # Check the mqtt connection status
-    def check_status_mqtt_connection(self, timeout=2):
-        
-        start_time = ticks_ms()
-        
+    # Check the mqtt connection status. Doesn't block or wait for a pong:
+    # the client notes when it last heard from the broker and pings an idle
+    # link, so this is down once a whole keepalive period has passed with
+    # nothing arriving (see MQTTClient.check_keepalive).
+    def check_status_mqtt_connection(self, timeout=None):
+        if self.mqtt_state != self.States.up:
+            return False
         try:
-            self.mqtt_connection.ping()
-            pong_recieved = False
-            while ticks_ms() - start_time < timeout * 1000 and not pong_recieved:
-                response = self.mqtt_connection.check_msg()
-                
-                if response == "pong":
-                    pong_recieved = True
-                 
-            if pong_recieved:
-                
-                print("miNetwork: mqtt pong recieved")
-                return True
-            else:
-                
-                print("miNetwork: no pong within timeout")
-                return False
-                
-        
-        except:
+            return self.mqtt_connection.check_keepalive()
+        except Exception:
             print("miNetwork: mqtt down")
             return False
 
-    # Connect to an mqtt broker
-    def connect_to_mqtt_broker(self, client_id, broker_address):
+    # Connect to an mqtt broker. With persistent_session the client id must
+    # be stable (it names the session on the broker) and subscriptions are
+    # made at QoS 1 so commands sent while we're offline are queued for us.
+    # protocol=5 talks MQTT 5 to the broker (see mqtt_protocol).
+    def connect_to_mqtt_broker(self, client_id, broker_address, persistent_session=None, protocol=None):
+        if persistent_session is not None:
+            self.persistent_session = persistent_session
+        if protocol is not None and protocol != self.mqtt_protocol:
+            self.mqtt_protocol = protocol
+            self.mqtt_connection = None
+        # reuse the client on reconnect: it keeps its routes and unacked messages
+        if self.mqtt_connection is None or self.mqtt_client != client_id or self.mqtt_server != broker_address:
+            self.mqtt_connection = None
         self.mqtt_client = client_id
         self.mqtt_server = broker_address
+        self.jitter = self._jitter_seed(client_id)
         try:
-            self.mqtt_connection = MQTTClient(self.mqtt_client, self.mqtt_server)
+            if self.mqtt_connection is None:
+                self.mqtt_connection = MQTTClient(
+                    self.mqtt_client, self.mqtt_server, keepalive=self.keepalive, protocol=self.mqtt_protocol, no_local=True
+                )
+            self.mqtt_connection.server_ip = self.broker_address()
             
-            self.mqtt_connection.connect()
+            self.session_present = self.mqtt_connection.connect(clean_session=not self.persistent_session)
+            self._mqtt_up()
             return True
         except:
             print("miNetwork: error connecting to mqtt server")
+            self._mqtt_down()
             return False
 
-    # check and re-instate mqtt connection
+    # Check the mqtt connection and work towards re-instating it if it's
+    # down. Each call advances the reconnect state machine a step (see
+    # step_mqtt), and check_for_messages advances it too. Only the step that
+    # starts an attempt blocks, for up to connect_timeout on the TCP connect
+    # (see _start_connect). Returns True while the connection is up.
     def check_mqtt_and_reconnect(self):
-        while not self.check_status_mqtt_connection():
-            
-            # show status showing we have lost mqtt
-            self.indicator_led.on()
-            sleep(0.1)
-            self.indicator_led.off()
-            sleep(0.1)
-            self.indicator_led.on()
-            sleep(0.1)
-            self.indicator_led.off()
-            sleep(0.7)
-
-            if self.connect_to_mqtt_broker(self.mqtt_client, self.mqtt_server):
-                self.resubscribe_to_all()
-        return True
-            
-        
-    # Send a string mqtt message
-    def send_mqtt_message(self, topic, message):
-        self.mqtt_connection.publish(topic, message)
+        if self.mqtt_state == self.States.up:
+            if not self.check_status_mqtt_connection():
+                self._mqtt_down()
+        return self.step_mqtt()
+
+    # Advance the reconnect state machine: disconnected -> connecting ->
+    # subscribing (skipped when the broker kept our session) -> up. While
+    # not up the indicator LED shows the double pulse. Returns True when up.
+    def step_mqtt(self):
+        state = self.mqtt_state
+        if state == self.States.up:
+            return True
+        if self.mqtt_server is None:
+            return False
+        now = ticks_ms()
+        self._show_disconnected(now)
+        if state == self.States.disconnected:
+            if ticks_diff(now, self.retry_at) >= 0:
+                self._start_connect(now)
+            return False
+        try:
+            self.mqtt_connection.check_msg()
+        except MQTTException as e:
+            # a refused subscription needn't hold the rest up
+            print(f"miNetwork: refused by broker {e}")
+            if state != self.States.subscribing:
+                self._mqtt_down()
+                return False
+            self._mqtt_up()
+            return True
+        except OSError as e:
+            print(f"miNetwork: reconnect failed {e}")
+            self._mqtt_down()
+            return False
+        if state == self.States.connecting:
+            if self.mqtt_connection.connack is not None:
+                self.session_present = self.mqtt_connection.connack
+                if self.session_present:
+                    print("miNetwork: session resumed, subscriptions kept")
+                elif self.subscription_list:
+                    self.resubscribe_pid = self.resubscribe_to_all()
+                    self._set_state(self.States.subscribing, now)
+                    return False
+                self._mqtt_up()
+                return True
+        elif self.resubscribe_pid not in self.mqtt_connection.sub_pending:
+            self._mqtt_up()
+            return True
+        if ticks_diff(now, self.state_timer) > self.state_timeout_ms:
+            print(f"miNetwork: timed out {state}")
+            self._mqtt_down()
+        return False
+
+    def _set_state(self, state, now=None):
+        self.mqtt_state = state
+        self.state_timer = ticks_ms() if now is None else now
+
+    # Send the CONNECT without waiting for the CONNACK. The TCP connect
+    # itself does block, for up to connect_timeout (s): once per attempt,
+    # so at most once per backoff while the broker is away.
+    def _start_connect(self, now):
+        self._set_state(self.States.connecting, now)
+        self.progress_ms = self.state_timer
+        self._refresh_broker()
+        self.mqtt_connection.server_ip = self.broker_address()
+        try:
+            self.mqtt_connection.connect(
+                clean_session=not self.persistent_session, timeout=self.connect_timeout, wait=False
+            )
+        except Exception as e:
+            print(f"miNetwork: error connecting to mqtt server {e}")
+            self._mqtt_down()
+
+    def _mqtt_up(self):
+        self._set_state(self.States.up)
+        # _show_disconnected may have left it on
+        self.indicator_led.off()
+        self.progress_ms = self.state_timer
+        self.mqtt_connects += 1
+        self.backoff_ms = self.backoff_min_ms
+        if self.down_since is not None:
+            self.down_ms = ticks_diff(self.state_timer, self.down_since)
+            self.down_since = None
+        # the broker is what the next boot checks a saved lease against
+        self._save_broker()
+        self.flush_offline_queue()
+        self.send_states()
+        # say we're back straight away rather than at the next heartbeat
+        if self.mqtt_connects > 1 and self.heartbeat_topic is not None:
+            self.send_heartbeat(self.heartbeat_topic)
+
+    # Schedule the next connection attempt after the current backoff, the
+    # second half of it offset by this prop's jitter, then double the backoff
+    def _mqtt_down(self):
+        self._set_state(self.States.disconnected)
+        self.progress_ms = self.state_timer
+        if self.down_since is None:
+            self.down_since = self.state_timer
+        half = self.backoff_ms // 2
+        self.retry_at = ticks_add(self.state_timer, half + half * self.jitter // 65536)
+        self.backoff_ms = min(self.backoff_ms * 2, self.backoff_max_ms)
+
+    # LED double pulse means disconnected (0.1 on, 0.1 off, 0.1 on, 0.7 off)
+    def _show_disconnected(self, now):
+        phase = ticks_diff(now, self.state_timer) % 1000
+        self.indicator_led.value(phase < 100 or 200 <= phase < 300)
+
+    # Send a string mqtt message. If it can't be sent (or older messages are
+    # still waiting) it is queued until the connection is back.
+    def send_mqtt_message(self, topic, message, key=None):
+        topic = self.publish_topics.get(topic, topic)
+        if self.mqtt_state != self.States.up or (self.offline_count and not self.flush_offline_queue()):
+            self.queue_message(topic, message, key)
+            return False
+        try:
+            self.mqtt_connection.publish(topic, message)
+            return True
+        except Exception:
+            print("miNetwork: publish failed, queueing message")
+            self.queue_message(topic, message, key)
+            self._mqtt_down()
+            return False
         
     # Send a json mqtt message
     def send_mqtt_json(self, topic, json_):
-        self.mqtt_connection.publish(topic, json.dumps(json_))
+        state = self._state_values(json_)
+        if state:
+            self.update_state(topic, state)
+        if self.coalesce:
+            return self._coalesce(topic, json_, self.snapshot_key(json_))
+        log.debug("sending json: %s", json_)
+        return self.send_mqtt_message(topic, json.dumps(json_), self.snapshot_key(json_))
+
+    # One compact frame describing how the prop is doing, sent in place of
+    # the old {"heartbeat": ...} messages and still carrying that key (with
+    # the IP address): uptime (s), main loop iterations per second and the
+    # longest iteration (ms) since the last frame, heap free and allocated,
+    # reconnects, messages published and received, messages queued while
+    # offline, how long (ms) the last outage lasted and how long (ms) this
+    # boot took to get on the network (see boot_timings).
+    def telemetry(self):
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self.loop_start)
+        if self.ip is None:
+            self.ip = self.nic.ifconfig()[0]
+        client = self.mqtt_connection
+        frame = {
+            "heartbeat": self.ip,
+            "up": ticks_diff(now, self.boot_time) // 1000,
+            "lps": self.loop_count * 1000 // elapsed if elapsed > 0 else 0,
+            "worst_ms": self.loop_worst_ms,
+            "mem_free": gc.mem_free(),
+            "mem_alloc": gc.mem_alloc(),
+            "reconnects": max(self.mqtt_connects - 1, 0),
+            "tx": client.sent if client else 0,
+            "rx": client.received if client else 0,
+            "queued": self.offline_count,
+            "down_ms": self.down_ms,
+            "boot": self.boot_timings,
+        }
+        self.loop_count = 0
+        self.loop_worst_ms = 0
+        self.loop_start = now
+        return frame
+
+    # Send the telemetry frame as the heartbeat
+    def send_heartbeat(self, topic):
+        self.heartbeat_topic = topic
+        if self.coalesce:
+            return self._coalesce(topic, self.telemetry(), "heartbeat")
+        return self.send_mqtt_message(topic, json.dumps(self.telemetry()), "heartbeat")
+
+    # Where in a heartbeat period of period_ms this prop should beat, so
+    # props started together don't all send at once
+    def heartbeat_offset(self, period_ms):
+        return period_ms * self.jitter // 65536
+
+    # FNV-1a of the MAC address and client id, folded to 16 bits. The MAC
+    # keeps boards apart even if they've been given the same client id.
+    def _jitter_seed(self, client_id):
+        try:
+            key = bytes(self.nic.config("mac")) + client_id.encode()
+        except Exception:
+            key = client_id.encode()
+        h = 2166136261
+        for b in key:
+            h = ((h ^ b) * 16777619) & 0xFFFFFFFF
+        return (h >> 16) ^ (h & 0xFFFF)
+
+    # Send what's in the log ring, oldest line first
+    def send_log(self, topic):
+        return self.send_mqtt_message(topic, json.dumps({"log": log.lines()}))
+
+    def _coalesce(self, topic, json_, key):
+        msgs = self.tick_msgs.get(topic)
+        if msgs is None:
+            msgs = self.tick_msgs[topic] = []
+            self.tick_topics.append(topic)
+        msgs.append((key, json_))
+        return True
+
+    # Send what was coalesced this tick: one message per topic. Snapshot
+    # messages only matter in their newest form. If at most one event style
+    # message (anything without a snapshot key) came in, everything merges
+    # into one JSON object; otherwise the topic gets a {"batch": [...]}
+    # frame with the messages in the order they were sent, so events keep
+    # their order.
+    def flush_tick(self):
+        for topic, message, key in self._tick_frames():
+            self.send_mqtt_message(topic, message, key)
+
+    # The messages coalesced this tick, as (topic, message, key) to send
+    def _tick_frames(self):
+        frames = []
+        for topic in self.tick_topics:
+            msgs = self.tick_msgs[topic]
+            events = 0
+            for key, json_ in msgs:
+                if key is None:
+                    events += 1
+            if len(msgs) == 1:
+                key, frame = msgs[0]
+            elif events <= 1:
+                key = None
+                frame = {}
+                for _, json_ in msgs:
+                    frame.update(json_)
+            else:
+                key = None
+                batch = []
+                for i in range(len(msgs)):
+                    k = msgs[i][0]
+                    if k is None or not any(later[0] == k for later in msgs[i + 1 :]):
+                        batch.append(msgs[i][1])
+                frame = {"batch": batch}
+            frames.append((topic, json.dumps(frame), key))
+        self.tick_topics = []
+        self.tick_msgs = {}
+        return frames
+
+    # Count a main loop iteration and note how long it took
+    # Call once per pass of the prop's main loop (PropRuntime calls it for
+    # each task run)
+    def loop_tick(self):
+        now = ticks_ms()
+        took = ticks_diff(now, self.loop_last)
+        self.loop_last = now
+        self.loop_count += 1
+        if took > self.loop_worst_ms:
+            self.loop_worst_ms = took
+
+    # Merge values into topic's state document and, if that changed it,
+    # publish it retained. send_mqtt_json does this for messages with a
+    # state key; props whose status is shaped differently call it directly.
+    def update_state(self, topic, values):
+        if not self._merge_state(topic, values):
+            return True
+        return self.send_states()
+
+    # The state keys in a json message, or None
+    def _state_values(self, json_):
+        if not isinstance(json_, dict):
+            return None
+        state = {}
+        for key in json_:
+            if key in self.state_keys:
+                state[key] = json_[key]
+        return state
+
+    # Merge values into topic's state document; True if it changed (and
+    # now needs sending)
+    def _merge_state(self, topic, values):
+        state = self.states.get(topic)
+        if state is None:
+            state = self.states[topic] = {}
+        for key in values:
+            state[key] = values[key]
+        doc = json.dumps(state)
+        if doc == self.state_json.get(topic):
+            return False
+        self.state_json[topic] = doc
+        if topic not in self.state_unsent:
+            self.state_unsent.append(topic)
+        return True
+
+    # Publish the state documents that haven't gone out yet (they're resent
+    # when the connection comes back)
+    def send_states(self):
+        if self.mqtt_state != self.States.up:
+            return False
+        while self.state_unsent:
+            topic = self.state_unsent[0]
+            try:
+                self.mqtt_connection.publish(topic + self.state_suffix, self.state_json[topic], retain=True)
+            except Exception:
+                print("miNetwork: state publish failed")
+                self._mqtt_down()
+                return False
+            self.state_unsent.pop(0)
+        return True
+
+    # The key a single-key snapshot message is coalesced under while queued
+    def snapshot_key(self, json_):
+        if isinstance(json_, dict) and len(json_) == 1:
+            for key in json_:
+                if key in self.snapshot_keys:
+                    return key
+        return None
+
+    # Add a message to the offline queue. A queued message with the same
+    # topic and snapshot key is dropped so only the newest is sent; when the
+    # queue is full the oldest message is lost.
+    def queue_message(self, topic, message, key=None):
+        size = self.offline_size
+        if key is not None:
+            for n in range(self.offline_count):
+                i = (self.offline_head + n) % size
+                if self.offline_key[i] == key and self.offline_topic[i] == topic:
+                    self.offline_msg[i] = None
+        if self.offline_count == size:
+            self._compact_offline()
+        if self.offline_count == size:
+            self.offline_dropped += 1
+            self._pop_offline()
+        i = (self.offline_head + self.offline_count) % size
+        self.offline_topic[i] = topic
+        self.offline_key[i] = key
+        self.offline_msg[i] = message
+        self.offline_count += 1
+
+    # Close up the gaps left by replaced snapshot messages
+    def _compact_offline(self):
+        size = self.offline_size
+        w = 0
+        for r in range(self.offline_count):
+            ri = (self.offline_head + r) % size
+            if self.offline_msg[ri] is None:
+                continue
+            if w != r:
+                wi = (self.offline_head + w) % size
+                self.offline_topic[wi] = self.offline_topic[ri]
+                self.offline_key[wi] = self.offline_key[ri]
+                self.offline_msg[wi] = self.offline_msg[ri]
+                self.offline_topic[ri] = self.offline_key[ri] = self.offline_msg[ri] = None
+            w += 1
+        self.offline_count = w
+
+    def _pop_offline(self):
+        i = self.offline_head
+        self.offline_topic[i] = self.offline_key[i] = self.offline_msg[i] = None
+        self.offline_head = (i + 1) % self.offline_size
+        self.offline_count -= 1
+
+    # Send everything queued while offline, oldest first. Stops at the first
+    # failure, leaving the rest queued; returns True once the queue is empty.
+    def flush_offline_queue(self):
+        while self.offline_count:
+            i = self.offline_head
+            if self.offline_msg[i] is not None:
+                try:
+                    self.mqtt_connection.publish(self.offline_topic[i], self.offline_msg[i])
+                except Exception:
+                    return False
+            self._pop_offline()
+        return True
         
-    # Subscribe to a topic and set callback
-    def subscribe_to_topic(self, topic, callback):
-        self.mqtt_connection.set_callback(callback)
-        self.mqtt_connection.subscribe(topic)
-        self.subscription_list[topic] = callback
+    # The topics commands for a prop's topic come in on, for topic_mode
+    def command_topics(self, topic):
+        if self.topic_mode == "split":
+            return (topic + "/cmd",)
+        if self.topic_mode == "compat":
+            return (topic, topic + "/cmd")
+        return (topic,)
+
+    # Subscribe to a topic and route its messages to callback. With
+    # copy=False the callback gets memoryviews of the receive buffer rather
+    # than bytes, and must copy anything it keeps after returning. If mqtt
+    # is down the subscription is made when it comes back.
+    # A prop's topic is subscribed on its command topics (see topic_mode),
+    # and what's sent to topic from then on goes to its publish topic.
+    def subscribe_to_topic(self, topic, callback, qos=None, copy=True):
+        if qos is None:
+            qos = 1 if self.persistent_session else 0
+        if self.topic_mode == "split":
+            self.publish_topics[topic] = topic + self.event_suffix
+        for sub in self.command_topics(topic):
+            self.mqtt_connection.add_route(sub, callback, copy)
+            if self.mqtt_state == self.States.up:
+                try:
+                    self.mqtt_connection.subscribe(sub, qos)
+                except Exception:
+                    self._mqtt_down()
+            self.subscription_list[sub] = callback
+            self.subscription_qos[sub] = qos
+            self.subscription_copy[sub] = copy
        
-    # resubscribe to all in list   
+    # resubscribe to all in list, as a single SUBSCRIBE packet. Returns its
+    # packet id.
     def resubscribe_to_all(self):
+        if not self.subscription_list:
+            return None
         for topic, callback in self.subscription_list.items():
             print(f"miNetwork: resubscribing to {topic} with {callback}")
-            self.subscribe_to_topic(topic, callback)
+            self.mqtt_connection.add_route(topic, callback, self.subscription_copy[topic])
+        return self.mqtt_connection.subscribe([(topic, self.subscription_qos[topic]) for topic in self.subscription_list])
         
-    # Check for any messages waiting - non-blocking
+    # Check for any messages waiting - non-blocking. While mqtt is down this
+    # moves the reconnect along instead (see check_mqtt_and_reconnect for
+    # the one step that can block).
     def check_for_messages(self):
-        return self.mqtt_connection.check_msg()
+        if self.tick_topics:
+            self.flush_tick()
+        msg = None
+        if self.mqtt_state != self.States.up:
+            self.step_mqtt()
+        else:
+            try:
+                msg = self.mqtt_connection.check_msg()
+            except (OSError, MQTTException) as e:
+                print(f"miNetwork: mqtt down {e}")
+                self._mqtt_down()
+            else:
+                self.progress_ms = self.mqtt_connection.last_rx
+        return msg
+
+    def progress(self):
+        return self.progress_ms
 
 
 
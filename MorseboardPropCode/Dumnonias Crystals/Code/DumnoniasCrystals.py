@@ -1,8 +1,10 @@
 from machine import Pin, SoftI2C, UART
 from libs.miNetwork import MINetwork
+from libs.runtime import PropRuntime
 from libs import webrepl
 from libs.debounced_input import DebouncedInput
 import json
+import uasyncio as asyncio
 from time import sleep, ticks_ms
 from neopixel import NeoPixel
 import sys
@@ -37,7 +39,7 @@ with open("config.json") as f:
     config = json.load(f)
     
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -75,17 +77,6 @@ class Puzzle:
    
     
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
-        self.indicator_led = Pin(25, Pin.OUT)
-        
-        
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
 
@@ -135,26 +126,6 @@ class Puzzle:
     def make_rainbow_array(self):
         pass
         
-    def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-            
-            self.heartbeat_timer = ticks_ms()
-           
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        if ticks_ms() - self.pong_timer > self.pong_timeout:
-            self.network.check_mqtt_and_reconnect()
-            self.pong_timer = ticks_ms()
-            
-        self.update_crystal_leds()
-        self.check_touchingSymbols()
-        self.update_room_leds()
-        self.check_buttons()
-        
     def check_buttons(self):
         status = self.buttons.check_buttons()
         if status != self.buttons.last_status:
@@ -320,29 +291,14 @@ class Puzzle:
                 
         self.crystal_leds.write()
     
-    def process_message(self, topic, raw_message):
-        message = raw_message.decode('utf-8')
-       
-        try:
-            message_json = json.loads(message)
-        except ValueError:
-            print("not valid JSON")
-            return
-    
-        if "button_colours" in message_json:
-            self.set_button_colours(message_json['button_colours'])
-            
-        if "crystal_colours" in message_json:
-            self.set_crystal_colours(message_json["crystal_colours"])
-            
-        if "latch_lock" in message_json:
-            if message_json["latch_lock"] == "open":
-                RELAY_PIN.on()
-                sleep(0.5)
-                RELAY_PIN.off()
+    async def latch_lock(self, action):
+        if action == "open":
+            RELAY_PIN.on()
+            await asyncio.sleep(0.5)
+            RELAY_PIN.off()
                 
-        if "touching_symbols_state" in message_json:
-            self.puzzle_json_generator({"symbols":self.touchingSymbolState})
+    def send_touching_symbols_state(self, value=None):
+        self.puzzle_json_generator({"symbols":self.touchingSymbolState})
             
     def button_pressed(self, button_id):
         self.puzzle_json_generator({"pressed":button_id})
@@ -364,14 +320,14 @@ class Puzzle:
 
 
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
-network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 
-
-        
- 
-while True:
-    
-    network.check_for_messages()
-        
-    puzzle.step()
-    sleep(0.01)
+runtime = PropRuntime(network, config["MQTT_TOPIC"])
+runtime.renderer("crystal_leds", puzzle.update_crystal_leds, hz=50)
+runtime.renderer("room_leds", puzzle.update_room_leds, hz=50)
+runtime.poller("touching_symbols", puzzle.check_touchingSymbols, hz=50)
+runtime.poller("buttons", puzzle.check_buttons, hz=50)
+runtime.on("button_colours", puzzle.set_button_colours)
+runtime.on("crystal_colours", puzzle.set_crystal_colours)
+runtime.on("latch_lock", puzzle.latch_lock)
+runtime.on("touching_symbols_state", puzzle.send_touching_symbols_state)
+runtime.run()
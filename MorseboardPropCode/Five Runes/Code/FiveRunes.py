@@ -3,6 +3,7 @@ from machine import Pin, SoftI2C
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 from libs import pn5180_morse
 from libs.expander import Expander, ExpanderPin
@@ -15,7 +16,7 @@ with open("config.json") as f:
     config = json.load(f)
 
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
     
 # load webrepl
@@ -85,17 +86,16 @@ class card_reader:
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
         self.relay_pin = Pin(22, Pin.OUT)
         
         self.network = network
         self.topic = topic
+        
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(1000, self.indicator_led.toggle)
                 
         self.relay_pin = Pin(22, Pin.OUT)
         self.relay_pin.off()
@@ -226,17 +226,12 @@ class Puzzle:
     
     
     
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
+        self.timers.run()
 
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-            
         if self.mode is "RFID":
             status = self.read_cards()
            
@@ -265,6 +260,9 @@ class Puzzle:
             print("not valid JSON")
             return
 
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
+
         if "mode" in message_json:
             self.mode = message_json["mode"]
             
@@ -289,6 +287,7 @@ network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 while True:
     
     sleep(0.01)
+    network.loop_tick()
   
     
     try:
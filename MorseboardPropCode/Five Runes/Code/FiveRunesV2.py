@@ -1,9 +1,12 @@
 from time import ticks_ms, sleep
 from machine import Pin, SoftI2C
 import json
+import uasyncio as asyncio
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.runtime import PropRuntime
 from libs import webrepl
+from libs import log
 from libs import pn5180_morse
 from libs.expander import Expander, ExpanderPin
 import random
@@ -16,7 +19,7 @@ with open("config.json") as f:
 
 NETWORK = True
 if NETWORK:
-    network = MINetwork()
+    network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
         
     # load webrepl
     webrepl.start()
@@ -73,13 +76,6 @@ class card_reader:
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
-        self.indicator_led = Pin(25, Pin.OUT)
-        
         self.network = network
         self.topic = topic
                 
@@ -151,7 +147,7 @@ class Puzzle:
         self.leds.write()    
             
             
-    def led_sequence(self, sequence):
+    async def led_sequence(self, sequence):
         
         def get_brightness(led_brightness):
             led_brightness += 5
@@ -188,7 +184,7 @@ class Puzzle:
                 if brightness > 255:
                     led_brightness = 255 - (brightness - 256)
                     
-                sleep(speed)
+                await asyncio.sleep(speed)
             
             self.leds[led_no] = [0,0,0]
                 
@@ -208,77 +204,52 @@ class Puzzle:
         
         return status
     
-    
-    
-    def step(self):
-        if NETWORK:
-            if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-                network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-                self.heartbeat_timer = ticks_ms()
-                
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-            
-        if self.mode is "RFID":
-            status = self.read_cards()
+    # read the readers one at a time, letting the LEDs and network run
+    # in between
+    async def check_cards(self):
+        if self.mode != "RFID":
+            return
+        status = {}
+        for card in self.cards:
+            result = card.read_card()
+            status[card.id] = result if result else None
+            await asyncio.sleep_ms(0)
            
-            if status != self.last_status:
-                print(status)
-                self.last_status = status
-                if NETWORK:
-                    network.send_mqtt_json(self.topic, {"cards" : status})
+        if status != self.last_status:
+            log.debug("cards %s", status)
+            self.last_status = status
+            if NETWORK:
+                network.send_mqtt_json(self.topic, {"cards" : status})
                  
-        else:
+    def render(self):
+        if self.mode != "RFID":
             self.update_LEDS()
         
             
-    def send_rfid_status(self):
+    def send_rfid_status(self, value=None):
         status = self.read_cards()
         self.last_status = status
         if NETWORK:
             network.send_mqtt_json(self.topic, {"cards" : status})
             
-    def process_message(self, topic, raw_message):
-        message = raw_message.decode('utf-8')
-       
-        try:
-            message_json = json.loads(message)
-        except ValueError:
-            print("not valid JSON")
-            return
-
-        if "mode" in message_json:
-            self.mode = message_json["mode"]
-            
+    def set_mode(self, mode):
+        self.mode = mode
         
-        if "led" in message_json:
-            print("led change")
-            self.led_brightness = 0
-            self.led_colour = message_json["led"]["colour"]
-            self.one_pulse = message_json["led"]["one_pulse"]
-            
+    def set_led(self, led):
+        print("led change")
+        self.led_brightness = 0
+        self.led_colour = led["colour"]
+        self.one_pulse = led["one_pulse"]
 
-        if "led_sequence" in message_json:
-            self.led_sequence(message_json["led_sequence"])
-            
-        if "rfid_status" in message_json:
-            self.send_rfid_status()
 
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
-if NETWORK:
-    network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 
-while True:
-    
-    sleep(0.01)
-  
-    if NETWORK:
-        try:
-            network.check_for_messages()
-        except:
-            network.check_mqtt_and_reconnect()
-    
-    puzzle.step()
+runtime = PropRuntime(network, config["MQTT_TOPIC"])
+runtime.poller("cards", puzzle.check_cards, hz=20)
+runtime.renderer("leds", puzzle.render, hz=50)
+runtime.on("mode", puzzle.set_mode)
+runtime.on("led", puzzle.set_led)
+runtime.on("led_sequence", puzzle.led_sequence, pauses="leds")
+runtime.on("rfid_status", puzzle.send_rfid_status)
+runtime.run()
     
@@ -156,7 +156,7 @@ class NFC:
             return False
 
         while _IDLE_IRQ_STAT != _IDLE_IRQ_STAT & int.from_bytes(irq_status, 'little'):
-            if (utime.ticks_ms() - starting_time) > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("Timeout waiting for reset to complete", 1)
                 return False
 
@@ -174,7 +174,7 @@ class NFC:
         # Step 0: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:0 timeout on waiting for bsy low")
                 return False
 
@@ -188,7 +188,7 @@ class NFC:
         # Step 3: wait for bsy to be high
         starting_time = utime.ticks_ms()
         while 1 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:5 timeout on waiting for bsy high")
                 return False
 
@@ -199,7 +199,7 @@ class NFC:
         # Step 5: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:5 timeout on waiting for bsy high")
                 return False
 
@@ -217,7 +217,7 @@ class NFC:
         # Step 8: wait for bsy to be high
         starting_time = utime.ticks_ms()
         while 1 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:8 timeout on waiting for bsy high")
                 return False
 
@@ -228,7 +228,7 @@ class NFC:
         # Step 10: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:10 timeout on waiting for bsy high")
                 return False
 
@@ -302,7 +302,7 @@ class NFC:
             # check RF IRQ is on
             starting_time = utime.ticks_ms()
             while _TX_RFON_IRQ_STAT != (_TX_RFON_IRQ_STAT & int.from_bytes(self.get_irq_status(), 'little')):
-                if utime.ticks_ms() - starting_time > self._timeout:
+                if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                     log("timeout on waiting for RF field to turn on")
                     return False
 
@@ -373,7 +373,7 @@ class NFC:
         # Wait for TS_wait_transmit
         starting_time = utime.ticks_ms()
         while _PN5180_TS_WaitTransmit != self.get_transceive_state():
-            if ( utime.ticks_ms() - starting_time) > 0.002:  # timeout waiting for a card 20ms
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > 0.002:  # timeout waiting for a card 20ms
                 log(" *** Error : timeout on waiting transceive state")
                 return False
 
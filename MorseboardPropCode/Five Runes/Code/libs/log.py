@@ -0,0 +1,111 @@
+# Logging for the props' hot paths.
+#
+#   from libs import log
+#   log.debug("sending json: %s", json_)
+#
+# A call below the current level returns straight away: the message isn't
+# formatted, stored or printed. Messages that pass are kept unformatted (the
+# format string and its args) in a fixed ring of the last SIZE entries and
+# only turned into text when someone looks - log.show() from the WebREPL, or
+# MINetwork.send_log over MQTT. Anything at or above echo is also printed to
+# serial as it happens. Args are kept by reference, so log values rather
+# than containers that get changed in place afterwards.
+from time import ticks_ms
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+_NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+SIZE = 32
+level = INFO
+echo = WARNING
+
+# the ring, as parallel lists so storing an entry doesn't allocate
+_ticks = [0] * SIZE
+_levels = [0] * SIZE
+_fmts = [None] * SIZE
+_args = [None] * SIZE
+_next = 0
+count = 0
+
+
+# Change how many entries are kept; this empties the ring
+def resize(size):
+    global SIZE, _ticks, _levels, _fmts, _args, _next, count
+    SIZE = size
+    _ticks = [0] * size
+    _levels = [0] * size
+    _fmts = [None] * size
+    _args = [None] * size
+    _next = 0
+    count = 0
+
+
+def log(lvl, fmt, *args):
+    global _next, count
+    if lvl < level:
+        return
+    i = _next
+    _ticks[i] = ticks_ms()
+    _levels[i] = lvl
+    _fmts[i] = fmt
+    _args[i] = args
+    _next = (i + 1) % SIZE
+    count += 1
+    if lvl >= echo:
+        print(_format(i))
+
+
+def debug(fmt, *args):
+    if level <= DEBUG:
+        log(DEBUG, fmt, *args)
+
+
+def info(fmt, *args):
+    if level <= INFO:
+        log(INFO, fmt, *args)
+
+
+def warning(fmt, *args):
+    if level <= WARNING:
+        log(WARNING, fmt, *args)
+
+
+def error(fmt, *args):
+    if level <= ERROR:
+        log(ERROR, fmt, *args)
+
+
+def _format(i):
+    fmt = _fmts[i]
+    args = _args[i]
+    try:
+        text = fmt % args if args else fmt
+    except (TypeError, ValueError):
+        text = f"{fmt} {args}"
+    return f"{_ticks[i]} {_NAMES.get(_levels[i], _levels[i])} {text}"
+
+
+# The kept entries as text, oldest first
+def lines():
+    n = min(count, SIZE)
+    start = (_next - n) % SIZE
+    return [_format((start + k) % SIZE) for k in range(n)]
+
+
+def show():
+    for line in lines():
+        print(line)
+
+
+def clear():
+    global _next, count
+    for i in range(SIZE):
+        _fmts[i] = None
+        _args[i] = None
+    _next = 0
+    count = 0
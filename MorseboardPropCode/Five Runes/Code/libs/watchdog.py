@@ -0,0 +1,100 @@
+# Hardware watchdog that's only fed while everything it watches is making
+# progress.
+#
+#   supervisor = Supervisor()
+#   supervisor.watch("loop", 20000)
+#   supervisor.watch("network", 300000, network.progress)
+#   supervisor.start()
+#   while True:
+#       supervisor.alive("loop")
+#       ...
+#
+# A task is late once its deadline has passed since it last called
+# alive(name) - or, for a task with a probe, since the ticks_ms value the
+# probe returns. A machine.Timer checks the deadlines every check_ms and
+# feeds the WDT while nothing is late. The timer runs between bytecodes and
+# inside sleep()s, so a deliberately long blocking move (like
+# RedDragon.go_to_station) is fine as long as it ends within the deadline.
+# Once a task is late the WDT isn't fed again: the task is written to
+# record_file and the board resets when the WDT runs out, and
+# Supervisor.last_reset() on the next boot returns that record.
+# The rp2 WDT can't be stopped once started and times out after at most
+# 8388ms.
+import machine
+import os
+from time import ticks_ms, ticks_diff
+import json
+from libs import log
+
+
+class Supervisor:
+    def __init__(self, timeout_ms=5000, check_ms=1000, record_file="watchdog.json"):
+        self.timeout_ms = timeout_ms
+        self.check_ms = check_ms
+        self.record_file = record_file
+        self.boot_time = ticks_ms()
+        # name: [deadline_ms, ticks of last alive(), probe]
+        self.tasks = {}
+        self.wdt = None
+        self.timer = None
+        self.late = None
+
+    def watch(self, name, deadline_ms, probe=None):
+        self.tasks[name] = [deadline_ms, ticks_ms(), probe]
+
+    def alive(self, name):
+        self.tasks[name][1] = ticks_ms()
+
+    def start(self):
+        now = ticks_ms()
+        for task in self.tasks.values():
+            task[1] = now
+        self.wdt = machine.WDT(timeout=self.timeout_ms)
+        self.timer = machine.Timer(period=self.check_ms, mode=machine.Timer.PERIODIC, callback=self._check)
+
+    # The first task past its deadline, as (name, ms since it was last
+    # seen), or None
+    def overdue(self):
+        now = ticks_ms()
+        for name in self.tasks:
+            deadline_ms, last, probe = self.tasks[name]
+            if probe is not None:
+                last = probe()
+            waited = ticks_diff(now, last)
+            if waited > deadline_ms:
+                return name, waited
+        return None
+
+    def _check(self, timer):
+        late = self.overdue()
+        if late is None:
+            self.wdt.feed()
+            return
+        timer.deinit()
+        self.late = late[0]
+        log.error("watchdog: %s missed its deadline by %dms, resetting", late[0], late[1] - self.tasks[late[0]][0])
+        self._record(late[0], late[1])
+
+    def _record(self, name, waited):
+        try:
+            with open(self.record_file, "w") as f:
+                json.dump({"task": name, "waited_ms": waited, "up_s": ticks_diff(ticks_ms(), self.boot_time) // 1000}, f)
+        except OSError as e:
+            print(f"watchdog: couldn't save record {e}")
+
+    # What the watchdog recorded before the last reset, if that reset was
+    # the watchdog's. The record is removed either way.
+    @staticmethod
+    def last_reset(record_file="watchdog.json"):
+        try:
+            with open(record_file) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.remove(record_file)
+        except OSError:
+            pass
+        if machine.reset_cause() != machine.WDT_RESET:
+            return None
+        return record
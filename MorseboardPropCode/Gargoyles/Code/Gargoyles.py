@@ -3,6 +3,7 @@ from machine import Pin
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 from libs import pn5180_morse # note - customised to use SPI 0, not 1 like other boards
 import random
@@ -13,7 +14,8 @@ import random
 with open("config.json") as f:
     config = json.load(f)
 
-network = MINetwork()
+# no keepalive: the loop only sends, it never reads from the broker
+network = MINetwork(keepalive=0, topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -53,17 +55,16 @@ class card_reader:
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
         self.relay_pin = Pin(22, Pin.OUT)
         
         self.network = network
         self.topic = topic
+        
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(1000, self.indicator_led.toggle)
                 
         self.relay_pin = Pin(22, Pin.OUT)
         self.relay_pin.off()
@@ -86,17 +87,12 @@ class Puzzle:
         
         return status
     
-    def step(self):
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
 
+    def step(self):
+        self.timers.run()
 
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
         status = self.read_cards()
         if status != self.last_status:
             print(status)
@@ -113,6 +109,9 @@ class Puzzle:
             print("not valid JSON")
             return
 
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
+
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
 
 network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
@@ -120,6 +119,7 @@ network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 while True:
     
     sleep(0.01)
+    network.loop_tick()
     #network.check_mqtt_and_reconnect()
     #network.check_for_messages()
     
@@ -3,7 +3,9 @@ from machine import Pin, SPI
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
+from libs import spi_tune
 from libs import pn5180_morse # note - customised to use SPI 0, not 1 like other boards
 import random
 
@@ -13,7 +15,7 @@ import random
 with open("config.json") as f:
     config = json.load(f)
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -50,7 +52,7 @@ class card_reader:
             self.cs.value(1)
 
             #self._spi = SPI(0, baudrate=1000000, sck=Pin(sck), mosi=Pin(mosi), miso=Pin(miso))
-            self.spi = SPI(spi_bus, baudrate=4000000, polarity=0, phase=0, sck=self.sck, mosi=self.mosi, miso=self.miso)
+            self.spi = SPI(spi_bus, baudrate=spi_tune.baudrate("mfrc522", 4000000), polarity=0, phase=0, sck=self.sck, mosi=self.mosi, miso=self.miso)
 
             self.spi.init()
 
@@ -321,17 +323,16 @@ configuration = Configuration("config_rfid.json")
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
         self.relay_pin = Pin(22, Pin.OUT)
         
         self.network = network
         self.topic = topic
+        
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(1000, self.indicator_led.toggle)
                 
         self.relay_pin = Pin(22, Pin.OUT)
         self.relay_pin.off()
@@ -391,17 +392,12 @@ class Puzzle:
         
         return status
     
-    def step(self):
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
 
+    def step(self):
+        self.timers.run()
 
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
         status = self.read_cards()
         if status != self.last_status:
             print(status)
@@ -417,6 +413,9 @@ class Puzzle:
         except ValueError:
             print("not valid JSON")
             return
+
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
         
         
         if "open_latch" in message_json:
@@ -440,6 +439,7 @@ network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 while True:
     
     sleep(0.01)
+    network.loop_tick()
     try:
         network.check_for_messages()
     except:
@@ -0,0 +1,370 @@
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+import json
+from libs.simple_mqtt import MQTTClient
+from libs.miNetwork import MINetwork
+
+
+# uasyncio versions of MQTTClient and MINetwork. The packet encoding and the
+# incremental parser are the ones in simple_mqtt; only the transport changes,
+# so the client waits for the socket to become readable instead of being
+# polled from the main loop.
+#
+#   network = AsyncMINetwork()
+#   network.connect_to_network()
+#
+#   async def main():
+#       await network.connect_to_mqtt_broker(config["MQTT_CLIENT"], config["MQTT_SERVER"])
+#       await network.subscribe_to_topic(config["MQTT_TOPIC"])
+#       asyncio.create_task(network.check_mqtt_and_reconnect())
+#       async for topic, message in network:
+#           puzzle.process_message(topic, message)
+#
+#   asyncio.run(main())
+
+
+# Lets the wire code in MQTTClient write to a uasyncio stream. Anything the
+# socket can't take straight away is buffered by the stream until drain().
+class _StreamSocket:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, buf, n=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self.writer.write(buf)
+        return len(buf)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+
+# Bounded FIFO of received (topic, message) pairs for "async for". When full
+# the oldest message is dropped.
+class _MessageQueue:
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.event = asyncio.Event()
+        self.closed = False
+
+    def put(self, topic, msg):
+        if len(self.items) >= self.size:
+            self.items.pop(0)
+        self.items.append((topic, msg))
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.items:
+            if self.closed:
+                raise StopAsyncIteration
+            self.event.clear()
+            await self.event.wait()
+        return self.items.pop(0)
+
+
+class AsyncMQTTClient(MQTTClient):
+    def __init__(self, client_id, server, port=0, queue_size=8, **kwargs):
+        super().__init__(client_id, server, port, **kwargs)
+        self.reader = None
+        self.writer = None
+        self.closed = True
+        self.ack_event = asyncio.Event()
+        # messages without a route of their own are queued for "async for"
+        self.messages = _MessageQueue(queue_size)
+        self.cb = self.messages.put
+
+    # timeout (seconds) bounds the TCP connect and the wait for the CONNACK
+    # together; on expiry asyncio.TimeoutError is raised
+    async def connect(self, clean_session=True, timeout=None):
+        self._reset_rx()
+        self.sub_pending = {}
+        self.messages.closed = False
+        self.writer = None
+        try:
+            await asyncio.wait_for(self._handshake(clean_session), timeout)
+        except Exception:
+            if self.writer is not None:
+                self.writer.close()
+            raise
+        present = self.connack
+        self.closed = False
+        asyncio.create_task(self._receive())
+        asyncio.create_task(self._keepalive())
+        return present
+
+    async def _handshake(self, clean_session):
+        self.reader, self.writer = await asyncio.open_connection(self.server_ip or self.server, self.port)
+        self.sock = _StreamSocket(self.writer)
+        self._send_connect(clean_session)
+        await self.writer.drain()
+        while self.connack is None:
+            tail, free = self._rx_space()
+            self._feed(tail, await self.reader.read(free))
+            while self._parse() is not None:
+                pass
+
+    async def disconnect(self):
+        if not self.closed:
+            self.writer.write(b"\xe0\0")
+            await self.writer.drain()
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            self.messages.close()
+            self.ack_event.set()
+
+    # QoS 1 publishes wait here (rather than spinning) while the in-flight
+    # window is full
+    async def publish(self, topic, msg, retain=False, qos=0):
+        while qos and self._free_slot() < 0:
+            if self.closed:
+                raise OSError(-1)
+            self.ack_event.clear()
+            await self.ack_event.wait()
+        if self.closed:
+            raise OSError(-1)
+        pid = MQTTClient.publish(self, topic, msg, retain, qos)
+        await self.writer.drain()
+        return pid
+
+    async def subscribe(self, topic, qos=0, no_local=None):
+        pid = MQTTClient.subscribe(self, topic, qos, no_local)
+        await self.writer.drain()
+        return pid
+
+    def _dispatch(self, op, pkt, sz):
+        res = MQTTClient._dispatch(self, op, pkt, sz)
+        if op == 0x40:
+            self.ack_event.set()
+        return res
+
+    def __aiter__(self):
+        return self.messages
+
+    # Background task: sleeps until the broker sends something, then feeds
+    # it through the parser. Ends (closing the client) when the link drops.
+    async def _receive(self):
+        try:
+            while not self.closed:
+                tail, free = self._rx_space()
+                self._feed(tail, await self.reader.read(free))
+                while self._parse() is not None:
+                    pass
+                # flush any PUBACKs written by the parser
+                await self.writer.drain()
+        except Exception as e:
+            print(f"async_mqtt: connection lost {e}")
+        self._close()
+
+    # Background task: pings an idle link and drops the connection if the
+    # broker stops answering (see MQTTClient.check_keepalive), and resends
+    # unacknowledged QoS 1 messages.
+    async def _keepalive(self):
+        try:
+            while not self.closed:
+                await asyncio.sleep(0.25)
+                if not self.check_keepalive():
+                    print("async_mqtt: keepalive timeout")
+                    break
+                if self.inflight:
+                    self._retry()
+                await self.writer.drain()
+        except Exception as e:
+            print(f"async_mqtt: keepalive failed {e}")
+        self._close()
+
+
+class AsyncMINetwork(MINetwork):
+    def __init__(self, network_type="dhcp", keepalive=30, queue_size=8, offline_queue_size=8, topic_mode="shared"):
+        super().__init__(network_type, offline_queue_size, keepalive, topic_mode=topic_mode)
+        # survives reconnects, unlike the client's own queue
+        self.messages = _MessageQueue(queue_size)
+
+    # Connect to an mqtt broker (see MINetwork.connect_to_mqtt_broker)
+    async def connect_to_mqtt_broker(self, client_id, broker_address, persistent_session=None, protocol=None):
+        if persistent_session is not None:
+            self.persistent_session = persistent_session
+        if protocol is not None and protocol != self.mqtt_protocol:
+            self.mqtt_protocol = protocol
+            self.mqtt_connection = None
+        if self.mqtt_connection is None or self.mqtt_client != client_id or self.mqtt_server != broker_address:
+            self.mqtt_connection = None
+        self.mqtt_client = client_id
+        self.mqtt_server = broker_address
+        self.jitter = self._jitter_seed(client_id)
+        try:
+            if self.mqtt_connection is None:
+                self.mqtt_connection = AsyncMQTTClient(
+                    self.mqtt_client, self.mqtt_server, keepalive=self.keepalive, protocol=self.mqtt_protocol, no_local=True
+                )
+                self.mqtt_connection.set_callback(self.messages.put)
+                for topic, callback in self.subscription_list.items():
+                    if callback is not None:
+                        self.mqtt_connection.add_route(topic, callback, self.subscription_copy[topic])
+            self._refresh_broker()
+            self.mqtt_connection.server_ip = self.broker_address()
+            self.session_present = await self.mqtt_connection.connect(
+                clean_session=not self.persistent_session, timeout=self.state_timeout_ms / 1000
+            )
+            self._set_state(self.States.up)
+            self.mqtt_connects += 1
+            self.backoff_ms = self.backoff_min_ms
+            if self.down_since is not None:
+                self.down_ms = ticks_diff(self.state_timer, self.down_since)
+                self.down_since = None
+            return True
+        except Exception:
+            print("miNetwork: error connecting to mqtt server")
+            return False
+
+    # Check the mqtt connection status - the client's tasks close it when
+    # the link or the keepalive fails
+    def check_status_mqtt_connection(self, timeout=0):
+        return self.mqtt_connection is not None and not self.mqtt_connection.closed
+
+    # Background task: re-instate the mqtt connection whenever it drops,
+    # retrying with the same backoff as MINetwork
+    async def check_mqtt_and_reconnect(self, interval=1):
+        while True:
+            if not self.check_status_mqtt_connection():
+                if self.mqtt_state == self.States.up:
+                    self._mqtt_down()
+                while ticks_diff(self.retry_at, ticks_ms()) > 0:
+                    await self.show_disconnected()
+                if await self.connect_to_mqtt_broker(self.mqtt_client, self.mqtt_server):
+                    if not self.session_present:
+                        await self.resubscribe_to_all()
+                    await self.flush_offline_queue()
+                    await self.send_states()
+                    if self.heartbeat_topic is not None:
+                        await self.send_heartbeat(self.heartbeat_topic)
+                    continue
+                self._mqtt_down()
+            await asyncio.sleep(interval)
+
+    # LED double pulse means disconnected
+    async def show_disconnected(self):
+        for value, t in ((1, 0.1), (0, 0.1), (1, 0.1), (0, 0.7)):
+            self.indicator_led.value(value)
+            await asyncio.sleep(t)
+
+    # Send a string mqtt message, queueing it while the broker is unreachable
+    async def send_mqtt_message(self, topic, message, key=None, qos=0):
+        topic = self.publish_topics.get(topic, topic)
+        if self.offline_count and not await self.flush_offline_queue():
+            self.queue_message(topic, message, key)
+            return False
+        try:
+            await self.mqtt_connection.publish(topic, message, qos=qos)
+            return True
+        except Exception:
+            print("miNetwork: publish failed, queueing message")
+            self.queue_message(topic, message, key)
+            return False
+
+    # Send a json mqtt message, updating the prop's state document (see
+    # MINetwork.update_state). With coalesce set, messages sent before the
+    # other ready tasks have run go out together, as in MINetwork.flush_tick
+    # (at qos 0).
+    async def send_mqtt_json(self, topic, json_, qos=0):
+        state = self._state_values(json_)
+        if state:
+            await self.update_state(topic, state)
+        if self.coalesce:
+            if not self.tick_topics:
+                asyncio.create_task(self.flush_tick())
+            return self._coalesce(topic, json_, self.snapshot_key(json_))
+        return await self.send_mqtt_message(topic, json.dumps(json_), self.snapshot_key(json_), qos)
+
+    async def flush_tick(self):
+        await asyncio.sleep_ms(0)
+        for topic, message, key in self._tick_frames():
+            await self.send_mqtt_message(topic, message, key)
+
+    async def update_state(self, topic, values):
+        if not self._merge_state(topic, values):
+            return True
+        return await self.send_states()
+
+    # Publish the state documents that haven't gone out yet, retained
+    async def send_states(self):
+        if not self.check_status_mqtt_connection():
+            return False
+        while self.state_unsent:
+            topic = self.state_unsent[0]
+            try:
+                await self.mqtt_connection.publish(topic + self.state_suffix, self.state_json[topic], retain=True)
+            except Exception:
+                print("miNetwork: state publish failed")
+                return False
+            self.state_unsent.pop(0)
+        return True
+
+    # Send the telemetry frame (see MINetwork.telemetry) as the heartbeat
+    async def send_heartbeat(self, topic):
+        self.heartbeat_topic = topic
+        return await self.send_mqtt_message(topic, json.dumps(self.telemetry()), "heartbeat")
+
+    async def flush_offline_queue(self):
+        while self.offline_count:
+            i = self.offline_head
+            if self.offline_msg[i] is not None:
+                try:
+                    await self.mqtt_connection.publish(self.offline_topic[i], self.offline_msg[i])
+                except Exception:
+                    return False
+            self._pop_offline()
+        return True
+
+    # Subscribe to a topic. With a callback its messages are routed there,
+    # otherwise they come out of "async for message in network". If mqtt is
+    # down the subscription is made by resubscribe_to_all when it's back.
+    async def subscribe_to_topic(self, topic, callback=None, qos=None, copy=True):
+        if qos is None:
+            qos = 1 if self.persistent_session else 0
+        if self.topic_mode == "split":
+            self.publish_topics[topic] = topic + self.event_suffix
+        for sub in self.command_topics(topic):
+            self.subscription_list[sub] = callback
+            self.subscription_copy[sub] = copy
+            self.subscription_qos[sub] = qos
+            if callback is not None and self.mqtt_connection is not None:
+                self.mqtt_connection.add_route(sub, callback, copy)
+            if not self.check_status_mqtt_connection():
+                continue
+            try:
+                await self.mqtt_connection.subscribe(sub, qos)
+            except Exception as e:
+                print(f"miNetwork: subscribe failed {e}")
+
+    # resubscribe to all in list, as a single SUBSCRIBE packet
+    async def resubscribe_to_all(self):
+        if not self.subscription_list:
+            return
+        for topic, callback in self.subscription_list.items():
+            if callback is not None:
+                self.mqtt_connection.add_route(topic, callback, self.subscription_copy[topic])
+        await self.mqtt_connection.subscribe([(topic, self.subscription_qos[topic]) for topic in self.subscription_list])
+
+    # Messages arrive by themselves - nothing to poll
+    def check_for_messages(self):
+        return None
+
+    def __aiter__(self):
+        return self.messages
@@ -1,6 +1,7 @@
 from machine import Pin, SPI
 from time import sleep
 import utime
+from libs import spi_tune
 
 DEBUG = False
 DEBUG_LEVEL = 4
@@ -106,7 +107,7 @@ _PN5180_TS_RESERVED = 7
 
 
 class NFC:
-    def __init__(self, nss_pin, rst_pin, bsy_pin, card_reader_id = None, sck=10, mosi=11, miso=12):
+    def __init__(self, nss_pin, rst_pin, bsy_pin, card_reader_id = None, sck=10, mosi=11, miso=12, baudrate=None):
 
 
         if type(nss_pin) is int:
@@ -128,8 +129,10 @@ class NFC:
 
         log(f"Initialised NFC:{card_reader_id} with nss={nss_pin}, rst={rst_pin}, bsy={bsy_pin}")
 
-        # start SPI
-        self._spi = SPI(1, baudrate=1000000, sck=Pin(sck), mosi=Pin(mosi), miso=Pin(miso))
+        # start SPI, at the board's calibrated rate unless one is given
+        if baudrate is None:
+            baudrate = spi_tune.baudrate("pn5180", 1000000)
+        self._spi = SPI(1, baudrate=baudrate, sck=Pin(sck), mosi=Pin(mosi), miso=Pin(miso))
         log(f"Initialised SPI with sck={sck}, mosi={mosi}, miso={miso}")
 
         self._timeout = 50  # set timeout to 200 ms
@@ -156,7 +159,7 @@ class NFC:
             return False
 
         while _IDLE_IRQ_STAT != _IDLE_IRQ_STAT & int.from_bytes(irq_status, 'little'):
-            if (utime.ticks_ms() - starting_time) > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("Timeout waiting for reset to complete", 1)
                 return False
 
@@ -174,7 +177,7 @@ class NFC:
         # Step 0: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:0 timeout on waiting for bsy low")
                 return False
 
@@ -188,7 +191,7 @@ class NFC:
         # Step 3: wait for bsy to be high
         starting_time = utime.ticks_ms()
         while 1 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:5 timeout on waiting for bsy high")
                 return False
 
@@ -199,7 +202,7 @@ class NFC:
         # Step 5: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:5 timeout on waiting for bsy high")
                 return False
 
@@ -217,7 +220,7 @@ class NFC:
         # Step 8: wait for bsy to be high
         starting_time = utime.ticks_ms()
         while 1 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:8 timeout on waiting for bsy high")
                 return False
 
@@ -228,7 +231,7 @@ class NFC:
         # Step 10: wait for bsy to be low
         starting_time = utime.ticks_ms()
         while 0 != self._bsy_pin.value():
-            if utime.ticks_ms() - starting_time > self._timeout:
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                 log("T:10 timeout on waiting for bsy high")
                 return False
 
@@ -302,7 +305,7 @@ class NFC:
             # check RF IRQ is on
             starting_time = utime.ticks_ms()
             while _TX_RFON_IRQ_STAT != (_TX_RFON_IRQ_STAT & int.from_bytes(self.get_irq_status(), 'little')):
-                if utime.ticks_ms() - starting_time > self._timeout:
+                if utime.ticks_diff(utime.ticks_ms(), starting_time) > self._timeout:
                     log("timeout on waiting for RF field to turn on")
                     return False
 
@@ -373,7 +376,7 @@ class NFC:
         # Wait for TS_wait_transmit
         starting_time = utime.ticks_ms()
         while _PN5180_TS_WaitTransmit != self.get_transceive_state():
-            if ( utime.ticks_ms() - starting_time) > 0.002:  # timeout waiting for a card 20ms
+            if utime.ticks_diff(utime.ticks_ms(), starting_time) > 0.002:  # timeout waiting for a card 20ms
                 log(" *** Error : timeout on waiting transceive state")
                 return False
 
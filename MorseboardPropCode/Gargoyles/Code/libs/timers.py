@@ -0,0 +1,118 @@
+from time import ticks_ms, ticks_diff, ticks_add
+from libs import log
+
+
+# Hierarchical timer wheel for the props' periodic jobs, in place of
+# checking "ticks_ms() - self.x_timer > self.x_timeout" for every timer on
+# every pass of the loop.
+#
+#   timers = TimerWheel()
+#   timers.every(1000, indicator_led.toggle)
+#   timers.every(10000, send_heartbeat, network.heartbeat_offset(10000))
+#   close = timers.after(500, relay.off)
+#   timers.cancel(close)
+#   while True:
+#       timers.run()
+#       ...
+#
+# Time moves in ticks of tick_ms. Level 0 has a slot per tick, and each level
+# up has slots as long as a whole turn of the level below, so the default
+# 10ms x 64 slots x 3 levels reaches 0.64s, 41s and 43min. Adding a timer
+# puts it straight into the slot for its due time, and run() only looks at
+# the slot for each tick that has passed - plus, once a turn, the next slot
+# up, whose timers are moved down a level. Timers further out than the top
+# level are parked in its last slot and placed again when it comes round.
+# Cancelling just marks the timer; it's dropped when its slot comes up.
+# Due times are ticks_ms values compared with ticks_diff, so they keep
+# working when ticks_ms wraps. A timer fires on the first run() at or after
+# its due time (rounded up to a tick). A periodic timer whose next run is
+# already past by the time it fires (run() wasn't called for a while) skips
+# the runs it missed rather than firing them back to back.
+class TimerWheel:
+    def __init__(self, tick_ms=10, slots=64, levels=3):
+        self.tick_ms = tick_ms
+        self.slots = slots
+        self.levels = levels
+        # ticks per slot at each level
+        self.spans = [slots ** level for level in range(levels)]
+        self.wrap = slots ** levels
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        # ticks since start, modulo wrap, and the ticks_ms it stands for
+        self.tick = 0
+        self.time = ticks_ms()
+        self.count = 0
+
+    # Call f once, ms from now
+    def after(self, ms, f):
+        return self._add(ticks_add(ticks_ms(), ms), 0, f)
+
+    # Call f every period_ms, the first time offset_ms from now (a period
+    # from now by default)
+    def every(self, period_ms, f, offset_ms=None):
+        if offset_ms is None:
+            offset_ms = period_ms
+        return self._add(ticks_add(ticks_ms(), offset_ms), period_ms, f)
+
+    # Stop a timer from after() or every()
+    def cancel(self, timer):
+        if timer[3]:
+            timer[3] = False
+            self.count -= 1
+
+    def _add(self, due, period_ms, f):
+        # [due (ticks_ms), period_ms (0 for once), f, active]
+        timer = [due, period_ms, f, True]
+        self.count += 1
+        self._place(timer)
+        return timer
+
+    # soonest is 0 while cascading, when the current tick's slot is still
+    # to be fired, and 1 otherwise
+    def _place(self, timer, soonest=1):
+        wait = ticks_diff(timer[0], self.time)
+        ticks = (wait + self.tick_ms - 1) // self.tick_ms
+        if ticks < soonest:
+            ticks = soonest
+        now = self.tick
+        due = now + ticks
+        for level in range(self.levels):
+            span = self.spans[level]
+            if due // span - now // span < self.slots:
+                self.wheels[level][(due // span) % self.slots].append(timer)
+                return
+        top = self.levels - 1
+        self.wheels[top][(now // self.spans[top] - 1) % self.slots].append(timer)
+
+    # Fire everything that's come due since the last run
+    def run(self):
+        now = ticks_ms()
+        while ticks_diff(now, self.time) >= self.tick_ms:
+            self.time = ticks_add(self.time, self.tick_ms)
+            self.tick = (self.tick + 1) % self.wrap
+            for level in range(1, self.levels):
+                span = self.spans[level]
+                if self.tick % span:
+                    break
+                slot = self.wheels[level][(self.tick // span) % self.slots]
+                while slot:
+                    timer = slot.pop()
+                    if timer[3]:
+                        self._place(timer, 0)
+            slot = self.wheels[0][self.tick % self.slots]
+            while slot:
+                timer = slot.pop()
+                if not timer[3]:
+                    continue
+                if timer[1]:
+                    timer[0] = ticks_add(timer[0], timer[1])
+                    late = ticks_diff(now, timer[0])
+                    if late >= 0:
+                        timer[0] = ticks_add(timer[0], (late // timer[1] + 1) * timer[1])
+                    self._place(timer)
+                else:
+                    timer[3] = False
+                    self.count -= 1
+                try:
+                    timer[2]()
+                except Exception as e:
+                    log.error("timers: %s failed: %s", timer[2], e)
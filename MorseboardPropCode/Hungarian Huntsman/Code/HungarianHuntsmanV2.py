@@ -1,4 +1,5 @@
 import time
+import uasyncio as asyncio
 from time import ticks_ms, sleep
 from machine import Pin, UART
 import json
@@ -7,6 +8,8 @@ from libs.miNetwork import MINetwork
 import random
 from libs.Stepper import Stepper
 from libs import webrepl
+from libs import log
+from libs.runtime import PropRuntime
 
 
 # load config
@@ -20,9 +23,12 @@ NETWORK = True
 uart = UART(1, baudrate=9600, tx=Pin(4), rx=Pin(5))
 # noinspection PyArgumentList
 uart.init(bits=8, parity=None, stop=2)
+# held for each command/reply exchange with the spiders, so the status
+# poller and the spider commands don't pick up each other's replies
+uart_lock = asyncio.Lock()
 
 if NETWORK:
-    network = MINetwork()
+    network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
     
     
 
@@ -72,7 +78,7 @@ class Spider:
         self.update_status()
         
         if self.state is not self.hunt:
-            print("ERROR!!! hasn't woken up")
+            log.warning("spider %s hasn't woken up", self.id)
         self.hunting_time = ticks_ms()
 
     def go_to_sleep(self):
@@ -80,7 +86,7 @@ class Spider:
         self.update_status()
 
         if self.state is not self.sleep:
-            print("ERROR!!! hasn't gone to sleep")
+            log.warning("spider %s hasn't gone to sleep", self.id)
         self.sleeping_time = ticks_ms()
 
 
@@ -88,14 +94,25 @@ class Spider:
         self.send_spider_command(self.kill)
         self.update_status()
         if self.state is not self.kill:
-            print("ERROR!!! hasn't died - probably dying")
+            log.warning("spider %s hasn't died - probably dying", self.id)
 
 
     def update_status(self):
         self.send_spider_command(self.get_status)
         sleep(0.06)
-        
+        return self.read_status()
+
+    # update_status, letting the other tasks run while the spider replies
+    async def poll_status(self):
+        async with uart_lock:
+            self.send_spider_command(self.get_status)
+            await asyncio.sleep(0.06)
+            return self.read_status()
+
+    def read_status(self):
         responses = self.get_spider_response()
+        if responses is None:
+            return self.state
         
         for response in responses:
             if response[0] == self.id:
@@ -128,11 +145,11 @@ class EggMover:
         self.stepper.set_speed(300)
         
         start_time = time.ticks_ms()  # capture start of home movement
-        while self.egg_sensor.value() > 0 and time.ticks_ms() - start_time < 5000:  # Egg isn't at home..
+        while self.egg_sensor.value() > 0 and time.ticks_diff(time.ticks_ms(), start_time) < 5000:  # Egg isn't at home..
             self.stepper.position = 0
             self.stepper.move_to(-40)
 
-        if (time.ticks_ms() - start_time) > 8000:
+        if time.ticks_diff(time.ticks_ms(), start_time) > 8000:
             print("EggMover: home not found - timing out", 1)
         self.stepper.position = 0
 
@@ -145,16 +162,6 @@ class EggMover:
 class Puzzle:
     
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
-        self.indicator_led = Pin(25, Pin.OUT)
-        
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.relay_pin = Pin(22, Pin.OUT)
         
         if NETWORK:
@@ -173,49 +180,39 @@ class Puzzle:
         self.initialise_egg()
         
     
-    def process_message(self, topic, raw_message):
-        message = raw_message.decode('utf-8')
-       
-        try:
-            message_json = json.loads(message)
-        except ValueError:
-            print("not valid JSON")
-            return
-
-
-        if "spider action" in message_json:
-            if message_json["spider action"] == "wake all":
-                self.wake_all_spiders()
-            
-            elif message_json["spider action"] == "sleep all":
-                self.sleep_all_spiders()()
-                
-            elif message_json["spider action"] == "kill all":
-                self.kill_all_spiders()()
-            else:
-                print(f"spider action not understood: {message_json}")
+    async def spider_action(self, action):
+        async with uart_lock:
+            self.run_spider_action(action)
+
+    def run_spider_action(self, action):
+        if action == "wake all":
+            self.wake_all_spiders()
+        elif action == "sleep all":
+            self.sleep_all_spiders()
+        elif action == "kill all":
+            self.kill_all_spiders()
+        else:
+            print(f"spider action not understood: {action}")
                 
-        if "spider multi action" in message_json:
-            cmds = message_json["spider multi action"]
-            
-            for cmd in cmds:
-                if cmd[1] == "wake":
-                    self.wake_spider_id(cmd[0])
-                if cmd[1] == "sleep":
-                    self.sleep_spider_id(cmd[0])
-                if cmd[1] == "kill":
-                    self.kill_spider_id(cmd[0])
-                    
-
-        if "egg position" in message_json:
-            if message_json["egg position"] == "go home":
-                self.egg_mover.go_home()
-            
-            if message_json["egg position"] == "go out":
-                self.egg_mover.go_out()
+    async def spider_multi_action(self, cmds):
+        async with uart_lock:
+            self.run_spider_multi_action(cmds)
+
+    def run_spider_multi_action(self, cmds):
+        for cmd in cmds:
+            if cmd[1] == "wake":
+                self.wake_spider_id(cmd[0])
+            if cmd[1] == "sleep":
+                self.sleep_spider_id(cmd[0])
+            if cmd[1] == "kill":
+                self.kill_spider_id(cmd[0])
+
+    def egg_position(self, position):
+        if position == "go home":
+            self.egg_mover.go_home()
         
-        if "light" in message_json:
-            self.light_control(message_json["light"])
+        if position == "go out":
+            self.egg_mover.go_out()
 
 
     def light_control(self, status):
@@ -226,23 +223,6 @@ class Puzzle:
             self.light_pin.off()
             print("light off")
 
-    def step(self):
-        if NETWORK:
-            if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-                network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-                self.heartbeat_timer = ticks_ms()
-                
-            if ticks_ms() - self.pong_timer > self.pong_timeout:
-                self.network.check_mqtt_and_reconnect()
-                self.pong_timer = ticks_ms()
-        
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        self.check_to_send_statuses()
-            
     
     def startup_indicator(self):
         for i in range(0,3):
@@ -298,7 +278,7 @@ class Puzzle:
             
     def wake_spider_id(self, _id):
         if _id in self.spiders: 
-            print(f"Waking spiker {_id}")
+            log.debug("waking spider %s", _id)
             self.spiders[_id].wake_up()
             
     def kill_spider_id(self, _id):
@@ -307,7 +287,7 @@ class Puzzle:
             
     def sleep_spider_id(self, _id):
         if _id in self.spiders:
-            print(_id)
+            log.debug("sleeping spider %s", _id)
             self.spiders[_id].go_to_sleep()
             
     def get_all_spiders_statuses(self):
@@ -321,41 +301,27 @@ class Puzzle:
             return self.spiders[_id].update_status()
         return
     
-    def check_to_send_statuses(self):
-        new_status = self.get_all_spiders_statuses()
+    async def check_to_send_statuses(self):
+        new_status = {}
+        for _id in self.spiders:
+            new_status[_id] = await self.spiders[_id].poll_status()
         if new_status != self.status:
             self.status = new_status
-            print(self.status)
+            log.debug("spiders %s", self.status)
             network.send_mqtt_json(self.topic, {"spiders" : self.status})
 
 
   
 
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
-if NETWORK:
-    network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
-
-
 puzzle.initialise_spiders([1, 2, 3, 4])
-while False:
-    network.check_for_messages()
-    puzzle.step()
-    sleep(0.01)
-
-
-
-# for use in final when need to check for dropped network
-while True:
-    if NETWORK:
-        try:
-            network.check_for_messages()
-        except:
-            print("error checking mqtt - this could be from within the functions")
-            network.check_mqtt_and_reconnect()
-    try:        
-        puzzle.step()
-    except:
-        print("issue in puzzle step")
-    sleep(0.01)
+
+runtime = PropRuntime(network, config["MQTT_TOPIC"])
+runtime.poller("spiders", puzzle.check_to_send_statuses, hz=4)
+runtime.on("spider action", puzzle.spider_action)
+runtime.on("spider multi action", puzzle.spider_multi_action)
+runtime.on("egg position", puzzle.egg_position)
+runtime.on("light", puzzle.light_control)
+runtime.run()
     
 
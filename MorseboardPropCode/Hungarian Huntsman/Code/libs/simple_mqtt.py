@@ -1,12 +1,20 @@
 import usocket as socket
 import ustruct as struct
 from ubinascii import hexlify
+from time import ticks_ms, ticks_diff, ticks_add
 
 
 class MQTTException(Exception):
     pass
 
 
+# MQTT 5 property identifiers by the size of their value (the rest are
+# strings or binary data, 0x26 a pair of strings, 0x0B a variable int)
+_PROP_BYTE = (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A)
+_PROP_U16 = (0x13, 0x21, 0x22, 0x23)
+_PROP_U32 = (0x02, 0x11, 0x18, 0x27)
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -17,16 +25,30 @@ class MQTTClient:
         password=None,
         keepalive=0,
         ssl=None,
+        pub_buf_size=256,
+        rx_buf_size=256,
+        pkt_buf_size=512,
+        inflight_max=4,
+        retry_ms=2000,
+        protocol=4,
+        topic_aliases=8,
+        no_local=False,
+        session_expiry=86400,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
+        # socket timeout from connect(), kept for reads and writes after it
+        self.timeout = None
         self.server = server
+        # address to connect to instead of looking server up each time
+        self.server_ip = None
         self.port = port
         self.ssl = ssl
         self.pid = 0
         self.cb = None
+        self.cb_copy = True
         self.user = user
         self.pswd = password
         self.keepalive = keepalive
@@ -34,23 +56,345 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # PUBLISH frames are built in this buffer and sent with a single write
+        self.pub_buf = bytearray(pub_buf_size)
+        # length-prefixed topic encodings, so regular topics aren't re-encoded
+        self.topic_cache = {}
+        self.topic_cache_size = 8
+        # incoming bytes land in a ring buffer and are parsed incrementally,
+        # packet bodies are assembled in pkt_buf (bigger ones get a temporary)
+        self.rx_buf = bytearray(rx_buf_size)
+        self.rx_mv = memoryview(self.rx_buf)
+        self.pkt_buf = bytearray(pkt_buf_size)
+        self.pkt_mv = memoryview(self.pkt_buf)
+        self.ack_buf = bytearray(b"\x40\x02\0\0")
+        self._reset_rx()
+        # SUBSCRIBE packet ids awaiting their SUBACK, mapped to their topics
+        self.sub_pending = {}
+        # per-topic handlers: a trie of topic filter levels (None holds the
+        # node's (handler, copy) pair) plus a cache of topics already resolved.
+        # The cache is a pair of lists so it can be searched with the
+        # memoryview of a received topic without copying it.
+        self.routes = {}
+        self.route_topics = []
+        self.route_handlers = []
+        self.route_cache_size = 16
+        # QoS 1 messages awaiting PUBACK, one slot per outstanding packet id
+        # (pid 0 marks a free slot); unacked messages are resent with DUP set
+        self.retry_ms = retry_ms
+        self.inflight = 0
+        self.inflight_pid = [0] * inflight_max
+        self.inflight_t = [0] * inflight_max
+        self.inflight_msg = [None] * inflight_max
+        # 4 for MQTT 3.1.1, 5 for MQTT 5. Under MQTT 5 published topics get
+        # topic aliases (up to topic_aliases of them, or fewer if the broker
+        # says so), subscriptions can be no_local so our own publishes
+        # aren't echoed back, and a persistent session is kept for
+        # session_expiry seconds after the connection drops.
+        self.protocol = protocol
+        self.topic_aliases = topic_aliases
+        self.no_local = no_local
+        self.session_expiry = session_expiry
+        self.alias_max = 0
+        self.aliases = {}
+        self.connack = None
+        # when we last heard from the broker and last sent it anything, for
+        # check_keepalive
+        self.last_rx = self.last_tx = self.last_ping = ticks_ms()
+        # PUBLISH packets sent (including resends) and received
+        self.sent = 0
+        self.received = 0
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
-    def _recv_len(self):
+    def _reset_rx(self):
+        self.rx_head = 0  # next unparsed byte in rx_buf
+        self.rx_count = 0  # number of unparsed bytes
+        self.rx_state = 0  # 0: fixed header, 1: remaining length, 2: body
+        self.rx_op = 0
+        self.rx_sz = 0
+        self.rx_shift = 0
+        self.rx_got = 0
+        self.rx_pkt = self.pkt_mv
+
+    # Contiguous free space after the buffered bytes: (offset, length)
+    def _rx_space(self):
+        size = len(self.rx_buf)
+        if self.rx_count == 0:
+            self.rx_head = 0
+        tail = (self.rx_head + self.rx_count) % size
+        if self.rx_count == size:
+            return tail, 0
+        return tail, (size if tail >= self.rx_head else self.rx_head) - tail
+
+    # Read whatever the socket has straight into the free part of the ring
+    # buffer. Returns number of bytes read, 0 if nothing was available.
+    def _fill(self, n=0):
+        tail, free = self._rx_space()
+        if not free:
+            return 0
+        n = self.sock.readinto(self.rx_mv[tail : tail + (n or free)])
+        if n is None:
+            return 0
+        if not n:
+            raise OSError(-1)
+        self.rx_count += n
+        self.last_rx = ticks_ms()
+        return n
+
+    def _feed(self, tail, data):
+        if data == b"":
+            raise OSError(-1)
+        self.rx_buf[tail : tail + len(data)] = data
+        self.rx_count += len(data)
+        self.last_rx = ticks_ms()
+        return len(data)
+
+    # Advance the parser over the buffered bytes. Returns the result of
+    # _dispatch once a complete packet is available, otherwise None and
+    # any partial header / length / body is kept for the next call.
+    def _parse(self):
+        size = len(self.rx_buf)
+        while 1:
+            if self.rx_state == 2:
+                n = min(self.rx_sz - self.rx_got, self.rx_count, size - self.rx_head)
+                if n:
+                    h = self.rx_head
+                    self.rx_pkt[self.rx_got : self.rx_got + n] = self.rx_mv[h : h + n]
+                    self.rx_got += n
+                    self.rx_head = (h + n) % size
+                    self.rx_count -= n
+                if self.rx_got < self.rx_sz:
+                    if self.rx_count:
+                        continue  # body wraps round the end of the ring
+                    return None
+                self.rx_state = 0
+                return self._dispatch(self.rx_op, self.rx_pkt, self.rx_sz)
+            if not self.rx_count:
+                return None
+            b = self.rx_buf[self.rx_head]
+            self.rx_head = (self.rx_head + 1) % size
+            self.rx_count -= 1
+            if self.rx_state == 0:
+                self.rx_op = b
+                self.rx_sz = 0
+                self.rx_shift = 0
+                self.rx_state = 1
+            else:
+                self.rx_sz |= (b & 0x7F) << self.rx_shift
+                self.rx_shift += 7
+                if not b & 0x80:
+                    self.rx_got = 0
+                    if self.rx_sz > len(self.pkt_buf):
+                        self.rx_pkt = memoryview(bytearray(self.rx_sz))
+                    else:
+                        self.rx_pkt = self.pkt_mv
+                    self.rx_state = 2
+
+    # Act on one complete packet (op is the fixed header byte, the body is
+    # the first sz bytes of the memoryview pkt). Topic and message are
+    # handed to handlers as memoryview slices of the receive buffer, only
+    # valid during the call, unless the handler asked for copies. A handler
+    # that raises is reported and skipped: the message is still acked and
+    # the connection is fine.
+    def _dispatch(self, op, pkt, sz):
+        if op == 0xD0:  # PINGRESP
+            return "pong"
+        if op & 0xF0 == 0x30:  # PUBLISH
+            topic_len = (pkt[0] << 8) | pkt[1]
+            topic = pkt[2 : 2 + topic_len]
+            i = 2 + topic_len
+            if op & 6:
+                pid = pkt[i] << 8 | pkt[i + 1]
+                i += 2
+            if self.protocol == 5:
+                i = self._properties(pkt, i)
+            msg = pkt[i:sz]
+            self.received += 1
+            handlers = self._handlers(topic)
+            if not handlers and self.cb is not None:
+                handlers = ((self.cb, self.cb_copy),)
+            copies = None
+            for f, copy in handlers:
+                try:
+                    if copy:
+                        if copies is None:
+                            copies = (bytes(topic), bytes(msg))
+                        f(copies[0], copies[1])
+                    else:
+                        f(topic, msg)
+                except Exception as e:
+                    print(f"mqtt: handler for {bytes(topic)} failed {repr(e)}")
+            if op & 6 == 2:
+                struct.pack_into("!H", self.ack_buf, 2, pid)
+                self.sock.write(self.ack_buf)
+                self.last_tx = ticks_ms()
+            elif op & 6 == 4:
+                assert 0
+        elif op == 0x40:  # PUBACK
+            pid = pkt[0] << 8 | pkt[1]
+            for i in range(len(self.inflight_pid)):
+                if self.inflight_pid[i] == pid:
+                    self.inflight_pid[i] = 0
+                    self.inflight_msg[i] = None
+                    self.inflight -= 1
+                    break
+        elif op == 0x90:  # SUBACK
+            topics = self.sub_pending.pop(pkt[0] << 8 | pkt[1], ())
+            start = self._properties(pkt, 2) if self.protocol == 5 else 2
+            for i in range(start, sz):
+                if pkt[i] >= 0x80:
+                    raise MQTTException(pkt[i], topics[i - start : i - start + 1])
+        elif op == 0x20:  # CONNACK
+            if pkt[1]:
+                raise MQTTException(pkt[1])
+            if self.protocol == 5:
+                self._properties(pkt, 2)
+            # anything still unacknowledged goes out again straight away
+            for i in range(len(self.inflight_pid)):
+                if self.inflight_pid[i]:
+                    self.inflight_t[i] = ticks_add(ticks_ms(), -self.retry_ms)
+            self.connack = pkt[0] & 1
+        return op
+
+    @staticmethod
+    def _varint(pkt, i):
         n = 0
-        sh = 0
+        shift = 0
         while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7F) << sh
+            b = pkt[i]
+            i += 1
+            n |= (b & 0x7F) << shift
+            shift += 7
             if not b & 0x80:
-                return n
-            sh += 7
+                return n, i
+
+    # Step over the MQTT 5 properties at pkt[i], returns the index after
+    # them. The only ones acted on come in the CONNACK: the broker's limit
+    # on topic aliases and its override of our keepalive.
+    def _properties(self, pkt, i):
+        n, i = self._varint(pkt, i)
+        end = i + n
+        while i < end:
+            p = pkt[i]
+            i += 1
+            if p in _PROP_BYTE:
+                i += 1
+            elif p in _PROP_U16:
+                v = pkt[i] << 8 | pkt[i + 1]
+                i += 2
+                if p == 0x22:  # Topic Alias Maximum
+                    self.alias_max = min(v, self.topic_aliases)
+                elif p == 0x13:  # Server Keep Alive
+                    self.keepalive = v
+            elif p in _PROP_U32:
+                i += 4
+            elif p == 0x0B:
+                i = self._varint(pkt, i)[1]
+            else:
+                for _ in range(2 if p == 0x26 else 1):
+                    i += 2 + (pkt[i] << 8 | pkt[i + 1])
+        return end
 
-    def set_callback(self, f):
+    # Length-prefixed encoding of a topic, cached for topics we publish often
+    def _topic_bytes(self, topic):
+        t = self.topic_cache.get(topic)
+        if t is None:
+            b = topic.encode() if isinstance(topic, str) else topic
+            t = struct.pack("!H", len(b)) + b
+            if len(self.topic_cache) < self.topic_cache_size:
+                self.topic_cache[topic] = t
+        return t
+
+    # Topic name and properties fields of a PUBLISH. Under MQTT 5 the first
+    # topics published on a connection are given a topic alias, and from
+    # then on are sent as just the alias with an empty topic name.
+    def _topic_fields(self, topic):
+        if self.protocol != 5:
+            return self._topic_bytes(topic), b""
+        props = self.aliases.get(topic)
+        if props is not None:
+            return b"\0\0", props
+        t = self._topic_bytes(topic)
+        n = len(self.aliases)
+        if n >= self.alias_max:
+            return t, b"\0"
+        n += 1
+        props = bytes((3, 0x23, n >> 8, n & 0xFF))
+        self.aliases[topic] = props
+        return t, props
+
+    # Catch-all handler for messages without a route. With copy=False it
+    # gets memoryviews instead of bytes, and must copy what it keeps.
+    def set_callback(self, f, copy=True):
         self.cb = f
+        self.cb_copy = copy
+
+    # Deliver messages whose topic matches topic_filter (which may use the
+    # + and # wildcards) to f instead of the catch-all callback. With
+    # copy=False f is passed memoryviews (see _dispatch).
+    def add_route(self, topic_filter, f, copy=True):
+        node = self.routes
+        for level in self._levels(topic_filter):
+            node = node.setdefault(level, {})
+        node[None] = (f, copy)
+        self._clear_route_cache()
+
+    def remove_route(self, topic_filter):
+        node = self.routes
+        for level in self._levels(topic_filter):
+            node = node.get(level)
+            if node is None:
+                return
+        node.pop(None, None)
+        self._clear_route_cache()
+
+    def _clear_route_cache(self):
+        self.route_topics = []
+        self.route_handlers = []
+
+    @staticmethod
+    def _levels(topic):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        return topic.split(b"/")
+
+    # Handlers for a received topic, resolved through the trie once and then
+    # served from the route cache
+    def _handlers(self, topic):
+        n = len(topic)
+        for i in range(len(self.route_topics)):
+            t = self.route_topics[i]
+            if len(t) == n and t == topic:
+                return self.route_handlers[i]
+        topic = bytes(topic)
+        h = []
+        levels = self._levels(topic)
+        self._match(self.routes, levels, 0, not levels[0].startswith(b"$"), h)
+        if len(self.route_topics) >= self.route_cache_size:
+            self._clear_route_cache()
+        self.route_topics.append(topic)
+        self.route_handlers.append(h)
+        return h
+
+    def _match(self, node, levels, i, wild, out):
+        # "a/#" matches "a" and everything below it
+        f = node.get(b"#", {}).get(None) if wild else None
+        if f is not None and f not in out:
+            out.append(f)
+        if i == len(levels):
+            f = node.get(None)
+            if f is not None and f not in out:
+                out.append(f)
+            return
+        child = node.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, True, out)
+        child = node.get(b"+") if wild else None
+        if child is not None:
+            self._match(child, levels, i + 1, True, out)
 
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
@@ -60,17 +404,54 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
+    # Returns the session present flag from the CONNACK. The same client can
+    # connect again after a drop; unacknowledged QoS 1 messages are resent.
+    # timeout (seconds) bounds the TCP connect. With wait=False connect
+    # returns None once the CONNECT is sent, and the CONNACK is picked up by
+    # check_msg, which sets self.connack to the session present flag.
+    def connect(self, clean_session=True, timeout=None, wait=True):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self._reset_rx()
+        self.sub_pending = {}
         self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.timeout = timeout
+        addr = socket.getaddrinfo(self.server_ip or self.server, self.port)[0][-1]
+        if timeout is not None:
+            self.sock.settimeout(timeout)
         self.sock.connect(addr)
         if self.ssl:
             self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+        self._send_connect(clean_session)
+        if not wait:
+            return None
+        # the CONNACK goes through the parser as MQTT 5 ones carry properties
+        self.sock.settimeout(timeout)
+        while self.connack is None:
+            self._fill(1)
+            self._parse()
+        return self.connack
+
+    def _send_connect(self, clean_session):
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        props = b""
+        # topic aliases belong to the network connection
+        self.alias_max = 0
+        self.aliases = {}
+        self.connack = None
+        self.last_rx = self.last_tx = self.last_ping = ticks_ms()
 
         sz = 10 + 2 + len(self.client_id)
+        msg[5] = self.protocol
         msg[6] = clean_session << 1
+        if self.protocol == 5:
+            # an MQTT 5 session ends with the connection unless given an expiry
+            props = b"\0" if clean_session else struct.pack("!BBI", 5, 0x11, self.session_expiry)
+            sz += len(props)
         if self.user:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
             msg[6] |= 0xC0
@@ -80,6 +461,8 @@ class MQTTClient:
             msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
             sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
+            if self.protocol == 5:
+                sz += 1
             msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
             msg[6] |= self.lw_retain << 5
 
@@ -92,19 +475,18 @@ class MQTTClient:
 
         self.sock.write(premsg, i + 2)
         self.sock.write(msg)
+        if props:
+            self.sock.write(props)
         # print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
+            if self.protocol == 5:
+                self.sock.write(b"\0")
             self._send_str(self.lw_topic)
             self._send_str(self.lw_msg)
         if self.user:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
 
     def disconnect(self):
         self.sock.write(b"\xe0\0")
@@ -112,101 +494,170 @@ class MQTTClient:
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.last_tx = self.last_ping = ticks_ms()
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+    # Passive liveness check, without blocking: sends a PINGREQ once the
+    # link has been idle (nothing received, or nothing sent) for half the
+    # keepalive period, and returns False once a whole period has gone by
+    # without anything arriving, i.e. that PINGREQ went unanswered.
+    # check_msg calls this, and raises OSError when it fails.
+    def check_keepalive(self):
+        if not self.keepalive:
+            return True
+        now = ticks_ms()
+        half = self.keepalive * 500
+        idle = ticks_diff(now, self.last_rx)
+        if idle > 2 * half:
+            return False
+        if (idle >= half or ticks_diff(now, self.last_tx) >= half) and ticks_diff(now, self.last_ping) >= half:
+            self.ping()
+        return True
+
+    def _send_publish(self, t, props, msg, retain, qos, pid, dup=False):
+        self.sent += 1
+        sz = len(t) + len(props) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        pkt = self.pub_buf
+        pkt[0] = 0x30 | dup << 3 | qos << 1 | retain
         i = 1
         while sz > 0x7F:
             pkt[i] = (sz & 0x7F) | 0x80
             sz >>= 7
             i += 1
         pkt[i] = sz
+        i += 1
+        if i + len(t) + len(props) + len(msg) + 2 <= len(pkt):
+            # whole frame fits: assemble it and send in one write
+            pkt[i : i + len(t)] = t
+            i += len(t)
+            if qos > 0:
+                struct.pack_into("!H", pkt, i, pid)
+                i += 2
+            pkt[i : i + len(props)] = props
+            i += len(props)
+            pkt[i : i + len(msg)] = msg
+            self.sock.write(pkt, i + len(msg))
+            self.last_tx = ticks_ms()
+        else:
+            # oversized payload: stream it after the header
+            self.sock.write(pkt, i)
+            self.sock.write(t)
+            if qos > 0:
+                self.sock.write(struct.pack("!H", pid))
+            if props:
+                self.sock.write(props)
+            self.sock.write(msg)
+            self.last_tx = ticks_ms()
+
+    # QoS 0 messages are fire and forget. QoS 1 messages take a slot in the
+    # in-flight window and publish returns their packet id straight away;
+    # the PUBACK is matched later by check_msg/wait_msg. If the window is
+    # full publish raises MQTTException straight away, without sending;
+    # the caller can keep the message and try again after check_msg.
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if qos == 0:
+            t, props = self._topic_fields(topic)
+            self._send_publish(t, props, msg, retain, 0, 0)
+            return None
+        slot = self._free_slot()
+        if slot < 0:
+            raise MQTTException("in-flight window full")
+        self.pid = self.pid % 65535 + 1
+        pid = self.pid
+        self.inflight_pid[slot] = pid
+        self.inflight_t[slot] = ticks_ms()
+        self.inflight_msg[slot] = (topic, msg, retain)
+        self.inflight += 1
+        t, props = self._topic_fields(topic)
+        self._send_publish(t, props, msg, retain, 1, pid)
+        return pid
+
+    def _free_slot(self):
+        for i in range(len(self.inflight_pid)):
+            if not self.inflight_pid[i]:
+                return i
+        return -1
+
+    # Resend QoS 1 messages whose PUBACK hasn't arrived within retry_ms
+    def _retry(self):
+        now = ticks_ms()
+        for i in range(len(self.inflight_pid)):
+            pid = self.inflight_pid[i]
+            if pid and ticks_diff(now, self.inflight_t[i]) >= self.retry_ms:
+                topic, msg, retain = self.inflight_msg[i]
+                self.inflight_t[i] = now
+                t, props = self._topic_fields(topic)
+                self._send_publish(t, props, msg, retain, 1, pid, True)
+
+    # Subscribe to one topic, or to a list of (topic, qos) pairs in a single
+    # SUBSCRIBE packet. Doesn't wait for the SUBACK: that is handled by
+    # check_msg/wait_msg like any other packet. Returns the packet id.
+    # no_local (MQTT 5 only) defaults to the client's setting.
+    def subscribe(self, topic, qos=0, no_local=None):
+        assert self.cb is not None or self.routes, "Subscribe callback is not set"
+        if isinstance(topic, (str, bytes)):
+            topic = [(topic, qos)]
+        options = 0
+        body = bytearray(2)
+        if self.protocol == 5:
+            if no_local is None:
+                no_local = self.no_local
+            options = no_local << 2
+            body.append(0)  # no properties
+        for t, q in topic:
+            body += self._topic_bytes(t)
+            body.append(q | options)
+        sz = len(body)
+        pkt = bytearray(b"\x82")
+        while sz > 0x7F:
+            pkt.append((sz & 0x7F) | 0x80)
+            sz >>= 7
+        pkt.append(sz)
+        self.pid = self.pid % 65535 + 1
+        struct.pack_into("!H", body, 0, self.pid)
+        self.sub_pending[self.pid] = [t for t, q in topic]
         # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
-
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        self.sock.write(pkt + body)
+        self.last_tx = ticks_ms()
+        return self.pid
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return "pong"
-        op = res[0]
-        if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-        return op
+        while 1:
+            res = self.check_msg()
+            if res is not None:
+                return res
+            # nothing complete yet, block until the next byte arrives
+            self.sock.setblocking(True)
+            self._fill(1)
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # the same processing as wait_msg. Never blocks: a partly
+    # received packet is kept and completed on a later call.
+    # Only the read is non-blocking, so the writes (PUBACKs, pings,
+    # publishes) always send their whole frame (or time out).
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
\ No newline at end of file
+        if self.keepalive and not self.check_keepalive():
+            raise OSError(-1)
+        if self.inflight:
+            self._retry()
+        while 1:
+            res = self._parse()
+            if res is not None:
+                return res
+            self.sock.setblocking(False)
+            try:
+                n = self._fill()
+            finally:
+                self.sock.settimeout(self.timeout)
+            if not n:
+                return None
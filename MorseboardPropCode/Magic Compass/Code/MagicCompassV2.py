@@ -1,8 +1,10 @@
-from time import ticks_ms, sleep
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff, sleep
 from machine import Pin
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.runtime import PropRuntime
 from libs import webrepl
 import random
 
@@ -12,7 +14,7 @@ with open("config.json") as f:
     config = json.load(f)
 
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 
@@ -27,16 +29,6 @@ network.connect_to_mqtt_broker(config["MQTT_CLIENT"], config["MQTT_SERVER"])
 class Puzzle:
     
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
-        self.indicator_led = Pin(25, Pin.OUT)
-        
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
         
@@ -58,27 +50,11 @@ class Puzzle:
         self.animals = Animals()
         
  
-    def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        if ticks_ms() - self.pong_timer > self.pong_timeout:
-            self.network.check_mqtt_and_reconnect()
-            self.pong_timer = ticks_ms()
-        
-        if ((ticks_ms() - self.last_change) > (self.current_duration * 1000)) and self.pointing:
+    def check_pointing(self):
+        if (ticks_diff(ticks_ms(), self.last_change) > (self.current_duration * 1000)) and self.pointing:
             self.led_colour = [0, 0, 0]
             self.compass.all_off()
             self.pointing = False
-            
-        self.update_LED()
-        
-        self.check_animals()
         
     def check_animals(self):
         status = self.animals.check_pins()
@@ -113,52 +89,28 @@ class Puzzle:
             self.LED[led] = [0, 0, 0]
         self.LED.write()
 
-    def process_message(self, topic, raw_message):
-        message = raw_message.decode('utf-8')
-       
-        try:
-            message_json = json.loads(message)
-        except ValueError:
-            print("not valid JSON")
-            return
-        print(message_json)
-        if "duration" in message_json:
-            self.current_duration = message_json["duration"]
+    def set_duration(self, duration):
+        self.current_duration = duration
             
-        if "led" in message_json:
-            self.led_colour = message_json["led"]
+    def set_led(self, led_colour):
+        self.led_colour = led_colour
             
-        action_made = False
-        if "direction" in message_json:
-            self.last_change = ticks_ms()
-            if message_json["direction"] is "north":
-                self.compass.point("north")
-                self.pointing = True
-                 
-            if message_json["direction"] is "south":
-                self.compass.point("south")
-                self.pointing = True
-                
-            if message_json["direction"] is "west":
-                self.compass.point("west")
-                self.pointing = True
-                
-            if message_json["direction"] is "east":
-                self.compass.point("east")
-                self.pointing = True
-                 
-            if message_json["direction"] is "none":
-                self.compass.all_off()
-                self.pointing = False
-                 
-            if message_json["direction"] is "spin":
-                for l in range(0,4):
-                    self.LED[l] = self.led_colour
-                    self.LED.brightness = 0
-                self.LED.write()
-                puzzle.incorrect(3, [0, 255, 0])
-                self.pointing = False
-                 
+    def set_direction(self, direction):
+        self.last_change = ticks_ms()
+        if direction in self.compass.points:
+            self.compass.point(direction)
+            self.pointing = True
+             
+        if direction == "none":
+            self.compass.all_off()
+            self.pointing = False
+             
+        if direction == "spin":
+            for l in range(0,4):
+                self.LED[l] = self.led_colour
+            self.LED.write()
+            self.pointing = False
+            asyncio.create_task(self.incorrect(3, [0, 255, 0]))
         
 
     def point(self, direction, led_colour, duration=None):
@@ -185,27 +137,19 @@ class Puzzle:
             self.LED[l] = [r,g,b]
             self.LED.write()
             
-    # this is a blocking function
-    def incorrect(self, duration, led_colour = [0, 255, 0]):
+    # spin round the compass for duration seconds, the led renderer pulses
+    # led_colour meanwhile
+    async def incorrect(self, duration, led_colour = [0, 255, 0]):
         start_time = ticks_ms()
         self.led_colour = led_colour
-        TICK_COUNT = 200
-        tick_to_change = TICK_COUNT
         directions = [Compass.Directions.West, Compass.Directions.South, Compass.Directions.East, Compass.Directions.North]
         direction = 0
-        while ticks_ms() - start_time < duration * 1000:
-            
-            sleep(0.001)
-            self.update_LED()
-            tick_to_change-=1
-            
-            if tick_to_change < 0:
-                tick_to_change = TICK_COUNT
-                direction +=1
-                if direction > 3:
-                    direction = 0
-                self.compass.point(directions[direction])
-                print(directions[direction])
+        while ticks_diff(ticks_ms(), start_time) < duration * 1000:
+            await asyncio.sleep_ms(400)
+            direction +=1
+            if direction > 3:
+                direction = 0
+            self.compass.point(directions[direction])
                 
         self.compass.all_off()
         self.led_colour = [0,0,0]
@@ -252,7 +196,7 @@ class Compass:
         start_time = ticks_ms()
         wait = 0.5
 
-        while (ticks_ms() - start_time) < (duration_s * 1000):
+        while ticks_diff(ticks_ms(), start_time) < (duration_s * 1000):
             for direction in [self.Directions.North, self.Directions.West, self.Directions.South, self.Directions.EAST]:
 
                 sleep(wait)
@@ -282,16 +226,15 @@ class Animals:
         return status
 
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
-network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 puzzle.boot_up_indication()
 
-while True:
-    try:
-        network.check_for_messages()
-    except:
-        network.check_mqtt_and_reconnect()
-        
-    puzzle.step()
-    sleep(0.01)
+runtime = PropRuntime(network, config["MQTT_TOPIC"])
+runtime.poller("pointing", puzzle.check_pointing, hz=20)
+runtime.poller("animals", puzzle.check_animals, hz=20)
+runtime.renderer("led", puzzle.update_LED, hz=100)
+runtime.on("duration", puzzle.set_duration)
+runtime.on("led", puzzle.set_led)
+runtime.on("direction", puzzle.set_direction)
+runtime.run()
     
 
@@ -3,6 +3,7 @@ from machine import Pin
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 import random
 
@@ -12,7 +13,7 @@ with open("config.json") as f:
     config = json.load(f)
 
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 
@@ -25,19 +26,16 @@ network.connect_to_mqtt_broker(config["MQTT_CLIENT"], config["MQTT_SERVER"])
 class Puzzle:
     
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
         
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(5000, network.check_mqtt_and_reconnect)
+        self.timers.every(1000, self.indicator_led.toggle)
+        
         self.communication = None
         
         INDICATOR_LED_PIN = 10
@@ -96,19 +94,11 @@ class Puzzle:
         return locations
 
  
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        if ticks_ms() - self.pong_timer > self.pong_timeout:
-            self.network.check_mqtt_and_reconnect()
-            self.pong_timer = ticks_ms()
-        
+        self.timers.run()
         self.check_locations()
         
         
@@ -121,6 +111,9 @@ class Puzzle:
             print("not valid JSON")
             return
         print(message_json)
+
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
         
         if "bookcase" in message_json:
             if message_json["bookcase"] == "open":
@@ -190,6 +183,7 @@ network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 
 while True:
     
+    network.loop_tick()
     network.check_for_messages()
     puzzle.step()
     sleep(0.01)
@@ -1,10 +1,12 @@
 from machine import Pin, SoftI2C, UART
 
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
+from libs.watchdog import Supervisor
 
 import json
-from time import sleep, ticks_ms
+from time import sleep, ticks_ms, ticks_diff
 from neopixel import NeoPixel
 
 import sys
@@ -27,7 +29,7 @@ INDICATOR_LED_PIN = 10
 with open("config.json") as f:
     config = json.load(f)
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -58,7 +60,7 @@ class RedDragon:
         start_time = ticks_ms()
         if self.station_pin.value() == 1:
             self.forward()
-            while self.station_pin.value() == 1 and (ticks_ms()-start_time) < 16000:
+            while self.station_pin.value() == 1 and ticks_diff(ticks_ms(), start_time) < 16000:
                 sleep(0.001)
                 pass
         self.stop()
@@ -68,7 +70,7 @@ class RedDragon:
         start_time = ticks_ms()
         if self.tunnel_pin.value() == 1:
             self.backward()
-            while self.tunnel_pin.value() == 1 and ((ticks_ms() - start_time) < 16000):
+            while self.tunnel_pin.value() == 1 and (ticks_diff(ticks_ms(), start_time) < 16000):
                 sleep(0.001)
                 pass
         self.stop()
@@ -85,35 +87,24 @@ class RedDragon:
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
-        self.pong_timer = ticks_ms()
-        self.pong_timeout = 5000
-        
         self.network = network
         self.topic = topic
         
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(5000, network.check_mqtt_and_reconnect)
+        self.timers.every(1000, self.indicator_led.toggle)
+        
         self.red_dragon = RedDragon()
     
  
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        if ticks_ms() - self.pong_timer > self.pong_timeout:
-            self.network.check_mqtt_and_reconnect()
-            self.pong_timer = ticks_ms()
-        
+        self.timers.run()
             
     def process_message(self, topic, raw_message):
         message = raw_message.decode('utf-8')
@@ -123,6 +114,9 @@ class Puzzle:
         except ValueError:
             print("not valid JSON")
             return
+
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
         
         if "direction" in message_json:
             if message_json["direction"] is "station":
@@ -149,7 +143,19 @@ class Puzzle:
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
 network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 
+# reset if the loop stops (moves take up to 16s) or the network has got
+# nowhere for 5 minutes - neither heard from the broker nor tried again
+last_reset = Supervisor.last_reset()
+if last_reset:
+    network.send_mqtt_json(config["MQTT_TOPIC"], {"watchdog": last_reset})
+supervisor = Supervisor()
+supervisor.watch("loop", 20000)
+supervisor.watch("network", 300000, network.progress)
+supervisor.start()
+
 while True:
+    supervisor.alive("loop")
+    network.loop_tick()
     try:
         network.check_for_messages()
     except:
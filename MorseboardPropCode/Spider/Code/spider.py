@@ -1,7 +1,7 @@
 from neopixel import NeoPixel
 from machine import UART, Pin
 from time import sleep
-from utime import ticks_ms
+from utime import ticks_ms, ticks_diff
 import json
 
 
@@ -44,7 +44,7 @@ class Spider:
 
     def update(self):
         # still dying?
-        if self.state == self.dying and ticks_ms() - self.shot_time > self.dying_time:
+        if self.state == self.dying and ticks_diff(ticks_ms(), self.shot_time) > self.dying_time:
             self.state = self.sleeping
 
     def set_colours(self, hunting, dormant, dying):
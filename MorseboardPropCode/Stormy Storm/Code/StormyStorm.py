@@ -1,8 +1,10 @@
 from time import ticks_ms, sleep
 from machine import Pin
 import json
+import uasyncio as asyncio
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.runtime import PropRuntime
 from libs import webrepl
 import random
 
@@ -12,7 +14,7 @@ with open("config.json") as f:
     config = json.load(f)
 
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -26,13 +28,6 @@ network.connect_to_mqtt_broker(config["MQTT_CLIENT"], config["MQTT_SERVER"])
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
-        self.indicator_led = Pin(25, Pin.OUT)
-        
         self.relay_pin = Pin(22, Pin.OUT)
         
         self.network = network
@@ -67,17 +62,7 @@ class Puzzle:
         self.rainbow_on = False
         self.UV_enabled = False
         
-    def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : network.nic.ifconfig()[0]})
-            self.heartbeat_timer = ticks_ms()
-            
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-        self.check_mag_switch()
-        
+    def render(self):
         if self.rainbow_on:
             self.rainbow_step()
     
@@ -87,7 +72,7 @@ class Puzzle:
         if status == "off":
             self.UV_Pin.off()
             
-    def lightening(self, status):
+    async def lightening(self, status):
         
         def led_action(status):
             for n in range(0,100):
@@ -104,10 +89,10 @@ class Puzzle:
             for timing in flash:
                 led_action(timing[1])
                 
-                sleep(timing[0] / 1000.0)
+                await asyncio.sleep(timing[0] / 1000.0)
         
         if status == "random_nine":
-            self.random_nine()
+            await self.random_nine()
             
             
 
@@ -159,7 +144,7 @@ class Puzzle:
                 self.np[n] = (0, 0, 0, 0)
             self.np.write()
         
-    def random_pulse(self, length):
+    async def random_pulse(self, length):
         def pick_random_consecutive_sequence(arr, X):
 
             Y = len(arr)
@@ -191,10 +176,10 @@ class Puzzle:
             
             led_action(led_picks, timing[1])
                 
-            sleep(timing[0] / 1000.0)
+            await asyncio.sleep(timing[0] / 1000.0)
             
             
-    def random_nine(self):
+    async def random_nine(self):
         
         def led_action(leds, status):
             
@@ -225,49 +210,24 @@ class Puzzle:
             
             led_action(action_leds, timing[1])
                 
-            sleep(timing[0] / 1000.0)
+            await asyncio.sleep(timing[0] / 1000.0)
      
             
-    def process_message(self, topic, raw_message):
-        message = raw_message.decode('utf-8')
-       
-        try:
-            message_json = json.loads(message)
-        except ValueError:
-            print("not valid JSON")
-            return
+    def enable_uv(self, enabled):
+        self.UV_enabled = enabled
         
-        if "enable_uv" in message_json:
-            self.UV_enabled = message_json["enable_uv"]
-
-        if "uv" in message_json:
-            self.uv_light_status(message_json["uv"])
-            
-        if "lightening" in message_json:
-            self.lightening(message_json["lightening"])
-            
-        if "random_pulse" in message_json:
-            self.random_pulse(message_json["random_pulse"])
-            
-        if "maglock" in message_json:
-            self.maglock(message_json["maglock"])
-            
-        if "rainbow" in message_json:
-            self.rainbow_pulse(message_json["rainbow"])
+    async def open_hootini(self, value=None):
+        # if maglock is off, pulse on in order to give power
+        if not self.maglock_on:
+            self.relay_pin.on()
             
+        self.hootini_switch.on()
+        await asyncio.sleep(0.2)
+        self.hootini_switch.off()
         
-        if "open_hootini" in message_json:
-            # if maglock is off, pulse on in order to give power
-            if not self.maglock_on:
-                self.relay_pin.on()
-                
-            self.hootini_switch.on()
-            sleep(0.2)
-            self.hootini_switch.off()
-            
-            # switch maglock off again if needed
-            if not self.maglock_on:
-                self.relay_pin.off()
+        # switch maglock off again if needed
+        if not self.maglock_on:
+            self.relay_pin.off()
         
             
             
@@ -281,10 +241,10 @@ class Puzzle:
             self.relay_pin.off()
             self.maglock_on = False
     
-    def check_mag_switch(self):
+    async def check_mag_switch(self):
         
         initial_value = self.mag_switch.value()
-        sleep(0.02)
+        await asyncio.sleep_ms(20)
         final_value = self.mag_switch.value()
         
         if initial_value == final_value:
@@ -300,13 +260,16 @@ class Puzzle:
                     network.send_mqtt_json(self.topic, {"uv_status" : "off"})
 
 puzzle = Puzzle(network, config["MQTT_TOPIC"])
-network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 
-while True:
-    
-    sleep(0.1)
-    network.check_mqtt_and_reconnect()
-    network.check_for_messages()
-    
-    puzzle.step()
+runtime = PropRuntime(network, config["MQTT_TOPIC"])
+runtime.poller("mag_switch", puzzle.check_mag_switch, hz=10)
+runtime.renderer("rainbow", puzzle.render, hz=10)
+runtime.on("enable_uv", puzzle.enable_uv)
+runtime.on("uv", puzzle.uv_light_status)
+runtime.on("lightening", puzzle.lightening, pauses="rainbow")
+runtime.on("random_pulse", puzzle.random_pulse, pauses="rainbow")
+runtime.on("maglock", puzzle.maglock)
+runtime.on("rainbow", puzzle.rainbow_pulse)
+runtime.on("open_hootini", puzzle.open_hootini)
+runtime.run()
     
\ No newline at end of file
@@ -0,0 +1,156 @@
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff, ticks_add
+from machine import Pin
+import json
+from libs import log
+
+
+# Runs a prop on uasyncio in place of the usual
+# "while True: check_for_messages(); puzzle.step(); sleep(0.01)" loop.
+#
+#   runtime = PropRuntime(network, config["MQTT_TOPIC"])
+#   runtime.poller("cards", puzzle.check_cards, hz=10)
+#   runtime.renderer("leds", puzzle.update_leds, hz=50)
+#   runtime.every("timeout", 1000, puzzle.check_timeout)
+#   runtime.on("mode", puzzle.set_mode)
+#   runtime.on("led_sequence", puzzle.led_sequence, pauses="leds")
+#   runtime.run()
+#
+# Every task runs at its own rate, and the network polling, heartbeat,
+# indicator LED and mqtt liveness check are built in. A task can be a plain
+# function or an async one; an async poller that awaits between slow steps
+# (one RFID reader at a time, say) lets the LEDs and the network run in
+# between. Handlers get the value of their key from each JSON message on the
+# prop's topic, in the order they were registered, and can also be async
+# (they're started as tasks, so a long animation doesn't hold up the
+# network). A handler registered with pauses=name stops that task (a
+# renderer drawing to the same LEDs, say) until it has finished. A task
+# that is late by more than its period skips the runs it missed rather
+# than running them back to back.
+class PropRuntime:
+    def __init__(self, network, topic, heartbeat_ms=10000, network_hz=100, indicator_pin=25):
+        self.network = network
+        self.topic = topic
+        # (name, function, period_ms, offset_ms)
+        self.tasks = []
+        # (key, handler, pauses), in the order they're checked
+        self.handlers = []
+        # name: [runs, longest run (ms), latest start (ms)] since the last report
+        self.stats = {}
+        # name: number of running handlers that have paused the task
+        self.paused = {}
+
+        if indicator_pin is not None:
+            self.indicator_led = Pin(indicator_pin, Pin.OUT)
+            self.every("indicator", 1000, self.indicator_led.toggle)
+        if network is not None:
+            self.every("network", 1000 // network_hz, network.check_for_messages)
+            self.every("heartbeat", heartbeat_ms, self.send_heartbeat, network.heartbeat_offset(heartbeat_ms))
+            self.every("mqtt", 5000, network.check_mqtt_and_reconnect)
+            self.on("log_dump", self.send_log)
+            self.on("runtime_stats", self.send_stats)
+
+    # Run f every period_ms, the first time offset_ms from start
+    def every(self, name, period_ms, f, offset_ms=0):
+        self.tasks.append((name, f, period_ms, offset_ms))
+        self.stats[name] = [0, 0, 0]
+
+    # Read a sensor hz times a second
+    def poller(self, name, f, hz):
+        self.every(name, 1000 // hz, f)
+
+    # Draw a frame hz times a second
+    def renderer(self, name, f, hz):
+        self.every(name, 1000 // hz, f)
+
+    # Call handler(value) for each message with key in it, pausing the task
+    # named pauses while it runs
+    def on(self, key, handler, pauses=None):
+        self.handlers.append((key, handler, pauses))
+
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
+    def send_log(self, value=None):
+        self.network.send_log(self.topic)
+
+    def send_stats(self, value=None):
+        self.network.send_mqtt_json(self.topic, {"runtime": self.report()})
+
+    # Per task: runs, longest run and latest start (ms) since the last report
+    def report(self):
+        report = {}
+        for name, stats in self.stats.items():
+            report[name] = {"runs": stats[0], "worst_ms": stats[1], "late_ms": stats[2]}
+            stats[0] = stats[1] = stats[2] = 0
+        return report
+
+    def _message(self, topic, raw_message):
+        try:
+            message = json.loads(raw_message)
+        except ValueError:
+            log.warning("runtime: not valid JSON")
+            return
+        if not isinstance(message, dict):
+            return
+        for key, handler, pauses in self.handlers:
+            if key in message:
+                if pauses is not None:
+                    self.paused[pauses] = self.paused.get(pauses, 0) + 1
+                try:
+                    result = handler(message[key])
+                except Exception as e:
+                    log.error("runtime: handler for %s failed: %s", key, e)
+                    result = None
+                if result is not None and hasattr(result, "send"):
+                    asyncio.create_task(self._finish(key, result, pauses))
+                elif pauses is not None:
+                    self.paused[pauses] -= 1
+
+    async def _finish(self, key, coro, pauses):
+        try:
+            await coro
+        except Exception as e:
+            log.error("runtime: handler for %s failed: %s", key, e)
+        if pauses is not None:
+            self.paused[pauses] -= 1
+
+    async def _run_every(self, name, f, period_ms, offset_ms):
+        stats = self.stats[name]
+        due = ticks_add(ticks_ms(), offset_ms)
+        while True:
+            wait = ticks_diff(due, ticks_ms())
+            await asyncio.sleep_ms(wait if wait > 0 else 0)
+            if not self.paused.get(name):
+                start = ticks_ms()
+                late = ticks_diff(start, due)
+                try:
+                    result = f()
+                    if result is not None and hasattr(result, "send"):
+                        await result
+                except Exception as e:
+                    log.error("runtime: %s failed: %s", name, e)
+                took = ticks_diff(ticks_ms(), start)
+                if self.network is not None:
+                    self.network.loop_tick()
+                stats[0] += 1
+                if took > stats[1]:
+                    stats[1] = took
+                if late > stats[2]:
+                    stats[2] = late
+            due = ticks_add(due, period_ms)
+            if ticks_diff(ticks_ms(), due) > period_ms:
+                due = ticks_ms()
+
+    async def _main(self):
+        for name, f, period_ms, offset_ms in self.tasks:
+            asyncio.create_task(self._run_every(name, f, period_ms, offset_ms))
+        while True:
+            await asyncio.sleep(60)
+
+    # Subscribe to the prop's topic and run forever. _message only parses
+    # the payload, so it can read it straight from the receive buffer.
+    def run(self):
+        if self.network is not None:
+            self.network.subscribe_to_topic(self.topic, self._message, copy=False)
+        asyncio.run(self._main())
@@ -0,0 +1,178 @@
+# SPI clock calibration. How fast a board's SPI devices can be clocked
+# depends on its wiring, so rather than one hard-coded rate for every board
+# the fastest rate that reads back cleanly is measured per board and device
+# and kept in spi.json. MINetwork (w5500), pn5180_morse.NFC (pn5180) and
+# the Gargoyles MFRC522 reader (mfrc522) set up their bus with
+# baudrate(name, default), so a calibrated rate is used from the next boot.
+#
+# From the serial REPL (not the WebREPL - the W5500 is reset while it's
+# being measured):
+#
+#   from libs import spi_tune
+#   spi_tune.calibrate_w5500()
+#   spi_tune.calibrate_readback("pn5180", nfc._spi, lambda: nfc.read_eeprom(0x12, 2))
+#   spi_tune.show()
+#   machine.reset()
+#
+# Each rate is run for `rounds` transfers, counting readback mismatches and
+# bus errors and timing the bytes moved. Rates go up until one has an error;
+# the fastest clean one is saved.
+from machine import Pin, SPI
+from time import sleep_ms, ticks_us, ticks_diff
+import json
+
+SPI_FILE = "spi.json"
+
+# rates to try per device, slowest first, up to what each part is rated for
+W5500_RATES = (2_000_000, 4_000_000, 8_000_000, 12_000_000, 16_000_000, 20_000_000, 24_000_000, 31_250_000)
+PN5180_RATES = (1_000_000, 2_000_000, 4_000_000, 7_000_000)
+MFRC522_RATES = (1_000_000, 2_000_000, 4_000_000, 8_000_000, 10_000_000)
+
+# W5500 common registers
+_GAR = 0x0001
+_VERSIONR = 0x0039
+_W5500_VERSION = 0x04
+
+_settings = None
+
+
+def _load():
+    global _settings
+    if _settings is None:
+        try:
+            with open(SPI_FILE) as f:
+                _settings = json.load(f)
+        except (OSError, ValueError):
+            _settings = {}
+    return _settings
+
+
+# The calibrated rate for a device, or default if it hasn't been calibrated
+def baudrate(name, default):
+    device = _load().get(name)
+    if device is None:
+        return default
+    return device["baudrate"]
+
+
+def _save(name, rate, results):
+    settings = _load()
+    settings[name] = {"baudrate": rate, "results": results}
+    try:
+        with open(SPI_FILE, "w") as f:
+            json.dump(settings, f)
+    except OSError as e:
+        print(f"spi_tune: couldn't save {SPI_FILE} {e}")
+
+
+def show():
+    for name, device in _load().items():
+        print(f"{name}: {device['baudrate']}")
+        for rate, result in device["results"].items():
+            print(f"    {rate}: {result['kbps']}kbps {result['errors']} errors")
+
+
+# Step spi through rates calling check(i) `rounds` times at each. check
+# returns the number of bytes it moved, or 0 if what it read back was
+# wrong. Returns the fastest rate without errors (or None) and the
+# per-rate results, and saves them under name if one was found.
+def calibrate(name, spi, check, rates, rounds=200, save=True):
+    best = None
+    results = {}
+    for rate in rates:
+        spi.init(baudrate=rate)
+        errors = 0
+        moved = 0
+        start = ticks_us()
+        for i in range(rounds):
+            try:
+                n = check(i)
+            except OSError:
+                n = 0
+            if n:
+                moved += n
+            else:
+                errors += 1
+        took = max(1, ticks_diff(ticks_us(), start))
+        results[str(rate)] = {"kbps": moved * 8000 // took, "errors": errors}
+        print(f"spi_tune: {name} at {rate}: {moved * 8000 // took}kbps, {errors} errors")
+        if errors:
+            break
+        best = rate
+    if save and best is not None:
+        _save(name, best, results)
+    return best, results
+
+
+# Calibrate a device by reading something that doesn't change (a version
+# register, say) and comparing it with what the slowest rate read
+def calibrate_readback(name, spi, read, rates=PN5180_RATES, rounds=200, save=True):
+    spi.init(baudrate=rates[0])
+    expected = read()
+    if not expected:
+        print(f"spi_tune: no reply from {name} at {rates[0]}")
+        return None, {}
+
+    def check(i):
+        got = read()
+        if got != expected:
+            return 0
+        return len(got) if isinstance(got, (bytes, bytearray)) else 1
+
+    return calibrate(name, spi, check, rates, rounds, save)
+
+
+def _w5500_read(spi, cs, addr, buf):
+    cs.value(0)
+    spi.write(bytes((addr >> 8, addr & 0xFF, 0x00)))
+    spi.readinto(buf)
+    cs.value(1)
+
+
+def _w5500_write(spi, cs, addr, data):
+    cs.value(0)
+    spi.write(bytes((addr >> 8, addr & 0xFF, 0x04)))
+    spi.write(data)
+    cs.value(1)
+
+
+# Calibrate the W5500 on the pins MINetwork uses. Each check reads VERSIONR,
+# writes a pattern to the gateway address register and reads it back, then
+# reads the whole common register block for throughput. The chip is reset
+# before and after, so run this before the network is set up and reset
+# the board afterwards.
+def calibrate_w5500(rates=W5500_RATES, rounds=200, save=True):
+    spi = SPI(0, rates[0], mosi=Pin(19), miso=Pin(16), sck=Pin(18))
+    cs = Pin(17, Pin.OUT, value=1)
+    rst = Pin(20, Pin.OUT)
+    rst.value(0)
+    sleep_ms(1)
+    rst.value(1)
+    sleep_ms(2)
+
+    version = bytearray(1)
+    gar = bytearray(4)
+    pattern = bytearray(4)
+    block = bytearray(64)
+
+    def check(i):
+        _w5500_read(spi, cs, _VERSIONR, version)
+        if version[0] != _W5500_VERSION:
+            return 0
+        pattern[0] = i & 0xFF
+        pattern[1] = 0x55
+        pattern[2] = 0xAA
+        pattern[3] = ~i & 0xFF
+        _w5500_write(spi, cs, _GAR, pattern)
+        _w5500_read(spi, cs, _GAR, gar)
+        if gar != pattern:
+            return 0
+        _w5500_read(spi, cs, 0, block)
+        return 4 + 7 + 7 + 67
+
+    try:
+        return calibrate("w5500", spi, check, rates, rounds, save)
+    finally:
+        rst.value(0)
+        sleep_ms(1)
+        rst.value(1)
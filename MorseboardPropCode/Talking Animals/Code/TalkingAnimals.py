@@ -3,6 +3,7 @@ from machine import Pin
 import json
 from neopixel import NeoPixel
 from libs.miNetwork import MINetwork
+from libs.timers import TimerWheel
 from libs import webrepl
 import random
 
@@ -12,7 +13,7 @@ with open("config.json") as f:
     config = json.load(f)
 
 
-network = MINetwork()
+network = MINetwork(topic_mode=config.get("MQTT_TOPICS", "shared"))
 
 
 # load webrepl
@@ -26,11 +27,6 @@ network.connect_to_mqtt_broker(config["MQTT_CLIENT"], config["MQTT_SERVER"])
 
 class Puzzle:
     def __init__(self, network, topic):
-        self.heartbeat_timer = ticks_ms()
-        self.heartbeat_timeout = 10000
-        
-        self.indicator_timer = ticks_ms()
-        self.indicator_timeout = 1000
         self.indicator_led = Pin(25, Pin.OUT)
         
         self.relay_pin = Pin(22, Pin.OUT)
@@ -38,18 +34,18 @@ class Puzzle:
         self.network = network
         self.topic = topic
         
+        self.timers = TimerWheel()
+        self.timers.every(10000, self.send_heartbeat, network.heartbeat_offset(10000))
+        self.timers.every(1000, self.indicator_led.toggle)
+        
         
         
+    def send_heartbeat(self):
+        self.network.send_heartbeat(self.topic)
+
     def step(self):
-        if ticks_ms() - self.heartbeat_timer > self.heartbeat_timeout:
-            network.send_mqtt_json(self.topic, {"heartbeat" : "alive"})
-            self.heartbeat_timer = ticks_ms()
+        self.timers.run()
             
-        if ticks_ms() - self.indicator_timer > self.indicator_timeout:
-            self.indicator_led.toggle()
-            self.indicator_timer = ticks_ms()
-            
-      
     def process_message(self, topic, raw_message):
         message = raw_message.decode('utf-8')
        
@@ -59,6 +55,9 @@ class Puzzle:
             print("not valid JSON")
             return
 
+        if "log_dump" in message_json:
+            self.network.send_log(self.topic)
+
         if "uv" in message_json:
             self.uv_light_status(message_json["uv"])
             
@@ -75,6 +74,7 @@ network.subscribe_to_topic(config["MQTT_TOPIC"], puzzle.process_message)
 while True:
     
     sleep(0.1)
+    network.loop_tick()
    
     network.check_for_messages()
     
@@ -0,0 +1,379 @@
+# Loopback benchmarks for libs/simple_mqtt.py, and for MINetwork's main
+# loop around it, so changes to the wire code can be measured without
+# flashing a board.
+#
+#   python3 bench_mqtt.py [--code "../Five Runes/Code"] [--broker host:port]
+#                         [--protocol 4|5] [--count 2000]
+#                         [--json results.json] [--compare old.json]
+#
+# Runs under CPython (with upy_compat standing in for the MicroPython
+# modules) or the MicroPython unix port. Without --broker an in-process
+# LoopbackBroker is started; that needs CPython, so under MicroPython point
+# it at a real mosquitto. The MINetwork case needs the LoopbackBroker (it
+# cuts the connection) and so only runs with it. Results go to stdout (or
+# --json) as JSON;
+# --compare prints the change against an earlier results file.
+import sys
+import gc
+import json
+
+import upy_compat
+
+upy_compat.install()
+from time import ticks_us, ticks_diff
+
+TOPIC = "MI/P/Bench"
+PAYLOADS = {
+    "cards": json.dumps({"cards": {"0": "04a1b2c3d4", "1": "04e5f6a7b8", "2": None, "3": "04c9d0e1f2", "4": None}}),
+    "heartbeat": json.dumps({"heartbeat": "192.168.1.50"}),
+    "alive": "alive",
+}
+
+
+# Counts the bytes going through the client's socket
+class _CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.tx = 0
+        self.rx = 0
+
+    def write(self, buf, n=None):
+        n = self.sock.write(buf) if n is None else self.sock.write(buf, n)
+        self.tx += n
+        return n
+
+    def readinto(self, buf):
+        n = self.sock.readinto(buf)
+        if n:
+            self.rx += n
+        return n
+
+    def read(self, n):
+        data = self.sock.read(n)
+        if data:
+            self.rx += len(data)
+        return data
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def settimeout(self, t):
+        self.sock.settimeout(t)
+
+    def close(self):
+        self.sock.close()
+
+
+# Average heap bytes allocated per call of f: gc.mem_alloc with the
+# collector off under MicroPython, the tracemalloc peak over each call
+# under CPython (which also counts the interpreter's own temporaries).
+# setup(i), if given, runs before each call and isn't counted.
+def allocs_per_call(f, n, setup=None):
+    if upy_compat.MICROPYTHON:
+        gc.collect()
+        gc.disable()
+        used = 0
+        for i in range(n):
+            if setup is not None:
+                setup(i)
+            before = gc.mem_alloc()
+            f(i)
+            used += gc.mem_alloc() - before
+        gc.enable()
+        return used / n
+    import tracemalloc
+
+    tracemalloc.start()
+    used = 0
+    for i in range(n):
+        if setup is not None:
+            setup(i)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        f(i)
+        used += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return used / n
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Bench:
+    def __init__(self, MQTTClient, host, port, protocol, count):
+        self.MQTTClient = MQTTClient
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.count = count
+        self.alloc_count = min(count, 200)
+
+    def client(self, name):
+        c = self.MQTTClient(name, self.host, self.port, protocol=self.protocol)
+        c.set_callback(lambda t, m: None)
+        c.connect()
+        c.sock = _CountingSocket(c.sock)
+        return c
+
+    # Service the connection until f() is true
+    @staticmethod
+    def spin(c, f, timeout_us=5000000):
+        start = ticks_us()
+        while not f():
+            c.check_msg()
+            if ticks_diff(ticks_us(), start) > timeout_us:
+                raise OSError("bench: timed out")
+
+    # publish, first servicing the connection until the QoS 1 window has
+    # room (publish raises rather than waiting)
+    def send(self, c, msg, qos):
+        if qos:
+            self.spin(c, lambda: c._free_slot() >= 0)
+        c.publish(TOPIC, msg, qos=qos)
+
+    def publish(self, name, qos):
+        c = self.client("bench-pub")
+        msg = PAYLOADS[name]
+        sock = c.sock
+        start = ticks_us()
+        for _ in range(self.count):
+            self.send(c, msg, qos)
+        self.spin(c, lambda: not c.inflight)
+        elapsed = ticks_diff(ticks_us(), start)
+        result = {
+            "msgs_per_s": round(self.count * 1000000 / elapsed),
+            "bytes_per_msg": round(sock.tx / self.count, 1),
+        }
+        result["alloc_bytes_per_msg"] = round(allocs_per_call(lambda i: self.send(c, msg, qos), self.alloc_count), 1)
+        self.spin(c, lambda: not c.inflight)
+        c.disconnect()
+        return result
+
+    # Publish to a topic we're subscribed to and time each message's round
+    # trip through the broker back into a handler
+    def latency(self, name):
+        c = self.client("bench-echo")
+        msg = PAYLOADS[name]
+        got = [0]
+
+        def handler(topic, message):
+            got[0] += 1
+
+        c.add_route(TOPIC + "/echo", handler, copy=False)
+        pid = c.subscribe(TOPIC + "/echo")
+        self.spin(c, lambda: pid not in c.sub_pending)
+        samples = []
+        for i in range(self.count):
+            start = ticks_us()
+            c.publish(TOPIC + "/echo", msg)
+            self.spin(c, lambda: got[0] > i)
+            samples.append(ticks_diff(ticks_us(), start))
+        c.disconnect()
+        return {
+            "p50_us": percentile(samples, 0.5),
+            "p99_us": percentile(samples, 0.99),
+            "max_us": max(samples),
+        }
+
+    # Another client sends batches of messages; time how long the receiver
+    # spends parsing and dispatching them
+    def receive(self, name, copy):
+        rx = self.client("bench-rx")
+        tx = self.client("bench-tx")
+        msg = PAYLOADS[name]
+        got = [0]
+
+        def handler(topic, message):
+            got[0] += 1
+
+        rx.add_route(TOPIC + "/rx", handler, copy=copy)
+        pid = rx.subscribe(TOPIC + "/rx")
+        self.spin(rx, lambda: pid not in rx.sub_pending)
+        sock = rx.sock
+        sock.rx = 0
+        batch = 50
+        elapsed = 0
+        sent = 0
+        while sent < self.count:
+            n = min(batch, self.count - sent)
+            for _ in range(n):
+                tx.publish(TOPIC + "/rx", msg)
+            sent += n
+            start = ticks_us()
+            self.spin(rx, lambda: got[0] >= sent)
+            elapsed += ticks_diff(ticks_us(), start)
+        result = {
+            "msgs_per_s": round(self.count * 1000000 / elapsed),
+            "bytes_per_msg": round(sock.rx / self.count, 1),
+        }
+
+        # the sender's publish is setup, so only the receive is counted
+        def send(i):
+            tx.publish(TOPIC + "/rx", msg)
+
+        def one(i):
+            while got[0] <= sent + i:
+                rx.check_msg()
+
+        result["alloc_bytes_per_msg"] = round(allocs_per_call(one, self.alloc_count, send), 1)
+        tx.disconnect()
+        rx.disconnect()
+        return result
+
+    # connect() on an existing client through to the SUBACK of its
+    # resubscription, as after a dropped link
+    def reconnect(self, broker):
+        c = self.client("bench-reconnect")
+        c.add_route(TOPIC + "/cmd", lambda t, m: None)
+        samples = []
+        for _ in range(min(self.count, 50)):
+            if broker is not None:
+                broker.drop_all()
+            start = ticks_us()
+            c.connect()
+            pid = c.subscribe(TOPIC + "/cmd")
+            self.spin(c, lambda: pid not in c.sub_pending)
+            samples.append(ticks_diff(ticks_us(), start))
+        c.disconnect()
+        return {
+            "p50_us": percentile(samples, 0.5),
+            "p99_us": percentile(samples, 0.99),
+        }
+
+    # MINetwork through a dropped link, driven only by check_for_messages as
+    # in a prop's main loop: the broker cuts it off, messages sent while it's
+    # down go into the offline queue, and it carries on until it has
+    # reconnected, resubscribed and the queue has reached a subscriber.
+    # Times how long it took to notice the drop, and from then until the
+    # queued messages arrived. The backoff is set to 0 so it's the
+    # reconnect being timed, not the wait before it.
+    def network(self, broker, MQTTClient, MINetwork, lease_file):
+        net = MINetwork(lease_file=lease_file)
+        net.backoff_min_ms = net.backoff_ms = 0
+        # MINetwork's client is on the default port: give it one for the
+        # bench broker, which connect_to_mqtt_broker then reuses
+        net.mqtt_protocol = self.protocol
+        net.mqtt_connection = MQTTClient(
+            "bench-net", self.host, self.port, keepalive=net.keepalive, protocol=self.protocol, no_local=True
+        )
+        net.mqtt_client = "bench-net"
+        net.mqtt_server = self.host
+        net.connect_to_mqtt_broker("bench-net", self.host)
+        net.subscribe_to_topic(TOPIC + "/cmd", lambda t, m: None)
+        msg = PAYLOADS["alive"]
+        queued = min(net.offline_size, 8)
+        got = [0]
+
+        def handler(topic, message):
+            got[0] += 1
+
+        detect = []
+        recover = []
+        for _ in range(min(self.count, 20)):
+            broker.drop_all()
+            rx = self.client("bench-net-rx")
+            rx.add_route(TOPIC + "/net", handler, copy=False)
+            pid = rx.subscribe(TOPIC + "/net")
+            self.spin(rx, lambda: pid not in rx.sub_pending)
+            got[0] = 0
+            start = ticks_us()
+            while net.mqtt_state == net.States.up:
+                net.check_for_messages()
+            detect.append(ticks_diff(ticks_us(), start))
+            start = ticks_us()
+            for _ in range(queued):
+                net.send_mqtt_message(TOPIC + "/net", msg)
+            while got[0] < queued:
+                net.check_for_messages()
+                rx.check_msg()
+                if ticks_diff(ticks_us(), start) > 5000000:
+                    raise OSError("bench: timed out")
+            recover.append(ticks_diff(ticks_us(), start))
+            rx.disconnect()
+        net.mqtt_connection.disconnect()
+        return {
+            "queued": queued,
+            "detect_p50_us": percentile(detect, 0.5),
+            "recover_p50_us": percentile(recover, 0.5),
+            "recover_p99_us": percentile(recover, 0.99),
+        }
+
+
+def compare(old, new):
+    for name, metrics in new["results"].items():
+        for metric, value in metrics.items():
+            before = old.get("results", {}).get(name, {}).get(metric)
+            if before:
+                change = (value - before) * 100 / before
+                print(f"{name:24} {metric:20} {before:>10} -> {value:>10}  {change:+.1f}%")
+
+
+def main(argv):
+    here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+    opts = {"--code": here + "/../Five Runes/Code", "--broker": None, "--protocol": "4", "--count": "2000", "--json": None, "--compare": None}
+    for i in range(1, len(argv), 2):
+        if argv[i] not in opts or i + 1 >= len(argv):
+            print("bench_mqtt: unknown option or missing value, see the top of bench_mqtt.py")
+            return 1
+        opts[argv[i]] = argv[i + 1]
+
+    sys.path.insert(0, opts["--code"])
+    from libs.simple_mqtt import MQTTClient
+
+    broker = None
+    if opts["--broker"]:
+        host, _, port = opts["--broker"].partition(":")
+        port = int(port or 1883)
+    else:
+        from loopback_broker import LoopbackBroker
+
+        broker = LoopbackBroker()
+        host, port = broker.host, broker.port
+
+    bench = Bench(MQTTClient, host, port, int(opts["--protocol"]), int(opts["--count"]))
+    results = {}
+    for name in PAYLOADS:
+        results["publish_qos0_" + name] = bench.publish(name, 0)
+    results["publish_qos1_cards"] = bench.publish("cards", 1)
+    results["latency_cards"] = bench.latency("cards")
+    results["latency_heartbeat"] = bench.latency("heartbeat")
+    results["receive_cards_copy"] = bench.receive("cards", True)
+    results["receive_cards_memoryview"] = bench.receive("cards", False)
+    results["reconnect"] = bench.reconnect(broker)
+    if broker is not None:
+        import os
+        import contextlib
+
+        upy_compat.install_board()
+        from libs.miNetwork import MINetwork
+
+        lease_file = "bench-lease.json"
+        # MINetwork reports reconnects on stdout, where the results go
+        with contextlib.redirect_stdout(sys.stderr):
+            results["network_drop_flush"] = bench.network(broker, MQTTClient, MINetwork, lease_file)
+        if lease_file in os.listdir():
+            os.remove(lease_file)
+        broker.close()
+
+    report = {
+        "implementation": sys.implementation.name,
+        "protocol": bench.protocol,
+        "count": bench.count,
+        "code": opts["--code"],
+        "results": results,
+    }
+    if opts["--json"]:
+        with open(opts["--json"], "w") as f:
+            json.dump(report, f)
+    else:
+        print(json.dumps(report))
+    if opts["--compare"]:
+        with open(opts["--compare"]) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
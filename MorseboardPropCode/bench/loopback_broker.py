@@ -0,0 +1,206 @@
+# In-process stand-in for mosquitto, for benchmarking on a PC. It speaks
+# the subset of MQTT 3.1.1 / 5 the props use: CONNECT, PUBLISH at QoS 0/1
+# (with topic aliases), SUBSCRIBE with + and # and no-local, PINGREQ and
+# DISCONNECT. No persistence, no retained messages, no auth.
+import socket
+import struct
+import threading
+
+
+def _encode_length(n):
+    out = bytearray()
+    while 1:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _varint(buf, i):
+    n = 0
+    shift = 0
+    while 1:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, i
+
+
+def topic_matches(topic_filter, topic):
+    f = topic_filter.split("/")
+    t = topic.split("/")
+    for i, level in enumerate(f):
+        if level == "#":
+            return True
+        if i >= len(t) or (level != "+" and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+class _Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.mqtt5 = False
+        self.subs = []  # (filter, no_local)
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+
+class LoopbackBroker:
+    def __init__(self, host="127.0.0.1", port=0, topic_alias_max=10):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(8)
+        self.host = host
+        self.port = self.listener.getsockname()[1]
+        self.topic_alias_max = topic_alias_max
+        self.connections = []
+        self.lock = threading.Lock()
+        self.rx_bytes = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.drop_all()
+        self.listener.close()
+
+    # Cut every client off without a DISCONNECT, as if the link dropped
+    def drop_all(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for c in connections:
+            try:
+                c.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # Publish from "the broker side" (another client, or node-red)
+    def publish(self, topic, msg, count=1):
+        for _ in range(count):
+            self._route(topic, msg, None)
+
+    def _accept(self):
+        while 1:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(_Connection(sock),), daemon=True).start()
+
+    def _recv_exact(self, sock, n):
+        buf = bytearray(n)
+        mv = memoryview(buf)
+        got = 0
+        while got < n:
+            k = sock.recv_into(mv[got:])
+            if not k:
+                raise EOFError
+            got += k
+        self.rx_bytes += n
+        return buf
+
+    def _serve(self, c):
+        try:
+            while 1:
+                op = self._recv_exact(c.sock, 1)[0]
+                n = 0
+                shift = 0
+                while 1:
+                    b = self._recv_exact(c.sock, 1)[0]
+                    n |= (b & 0x7F) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = self._recv_exact(c.sock, n)
+                kind = op & 0xF0
+                if kind == 0x10:
+                    self._connect(c, body)
+                elif kind == 0x30:
+                    self._publish(c, op, body)
+                elif kind == 0x80:
+                    self._subscribe(c, body)
+                elif kind == 0xC0:
+                    c.send(b"\xd0\0")
+                elif kind == 0xE0:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                if c in self.connections:
+                    self.connections.remove(c)
+            c.sock.close()
+
+    def _connect(self, c, body):
+        i = 2 + struct.unpack_from("!H", body, 0)[0]
+        c.mqtt5 = body[i] == 5
+        # before the CONNACK, so a drop_all once the client is up reaches it
+        with self.lock:
+            self.connections.append(c)
+        if c.mqtt5:
+            props = bytes((0x22,)) + struct.pack("!H", self.topic_alias_max)
+            c.send(bytes((0x20, 3 + len(props), 0, 0, len(props))) + props)
+        else:
+            c.send(b"\x20\x02\0\0")
+
+    def _publish(self, c, op, body):
+        n = struct.unpack_from("!H", body, 0)[0]
+        topic = bytes(body[2 : 2 + n]).decode()
+        i = 2 + n
+        if op & 6:
+            pid = bytes(body[i : i + 2])
+            i += 2
+        if c.mqtt5:
+            n, i = _varint(body, i)
+            end = i + n
+            while i < end:
+                if body[i] != 0x23:
+                    raise ValueError("unexpected PUBLISH property %d" % body[i])
+                alias = struct.unpack_from("!H", body, i + 1)[0]
+                i += 3
+                if topic:
+                    c.aliases[alias] = topic
+                else:
+                    topic = c.aliases[alias]
+        if op & 6:
+            c.send(b"\x40\x02" + pid)
+        self._route(topic, bytes(body[i:]), c)
+
+    def _subscribe(self, c, body):
+        pid = bytes(body[:2])
+        i = 2
+        if c.mqtt5:
+            n, i = _varint(body, i)
+            i += n
+        codes = bytearray()
+        while i < len(body):
+            n = struct.unpack_from("!H", body, i)[0]
+            c.subs.append((bytes(body[i + 2 : i + 2 + n]).decode(), bool(body[i + 2 + n] & 4)))
+            codes.append(min(body[i + 2 + n] & 3, 1))
+            i += 3 + n
+        if c.mqtt5:
+            codes[0:0] = b"\0"
+        c.send(b"\x90" + _encode_length(2 + len(codes)) + pid + codes)
+
+    def _route(self, topic, msg, origin):
+        tb = topic.encode()
+        with self.lock:
+            connections = list(self.connections)
+        for c in connections:
+            for f, no_local in c.subs:
+                if topic_matches(f, topic) and not (no_local and c is origin):
+                    body = struct.pack("!H", len(tb)) + tb + (b"\0" if c.mqtt5 else b"") + msg
+                    try:
+                        c.send(b"\x30" + _encode_length(len(body)) + body)
+                    except OSError:
+                        pass
+                    break
@@ -0,0 +1,161 @@
+# Measures how long the props take to come back after the broker restarts.
+#
+#   python3 recovery.py [--code "../Five Runes/Code"] [--broker host:port]
+#                       [--topic "MI/PRODIGY/PUZZLE/#"] [--learn 25]
+#                       [--restart "sudo systemctl restart mosquitto"]
+#                       [--timeout 120] [--json results.json]
+#
+# First it listens for --learn seconds to find the props (anything sending
+# a heartbeat frame under --topic). Then it runs --restart, or without one
+# waits for the broker to go away by itself, and times from then until each
+# prop has sent a heartbeat showing it has reconnected - MINetwork sends one
+# as soon as it's back. Reports, as JSON, when each prop was healthy again
+# (ms after the restart) and when all of them were.
+import sys
+import json
+
+import upy_compat
+
+upy_compat.install()
+from time import ticks_ms, ticks_diff, sleep_ms
+
+
+# The prop a message on topic came from ("<topic>/event" in split mode)
+def prop_of(topic):
+    if topic.endswith("/event"):
+        return topic[:-6]
+    return topic
+
+
+class Recovery:
+    def __init__(self, MQTTClient, host, port, topic):
+        self.MQTTClient = MQTTClient
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.client = None
+        # prop: reconnects in its last heartbeat
+        self.reconnects = {}
+        # prop: ms after the restart it was back
+        self.healthy = {}
+        self.restart_at = None
+
+    def connect(self):
+        c = self.MQTTClient("recovery-%d" % ticks_ms(), self.host, self.port)
+        c.set_callback(self.message)
+        c.connect()
+        c.subscribe(self.topic)
+        self.client = c
+
+    def message(self, topic, msg):
+        try:
+            frame = json.loads(msg)
+        except ValueError:
+            return
+        if not isinstance(frame, dict) or "reconnects" not in frame:
+            return
+        prop = prop_of(topic.decode() if isinstance(topic, bytes) else topic)
+        before = self.reconnects.get(prop)
+        self.reconnects[prop] = frame["reconnects"]
+        if self.restart_at is None or prop in self.healthy:
+            return
+        if before is not None and frame["reconnects"] > before:
+            self.healthy[prop] = ticks_diff(ticks_ms(), self.restart_at)
+
+    def listen(self, ms):
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < ms:
+            self.client.check_msg()
+            sleep_ms(5)
+
+    # Service the connection until the broker drops it
+    def wait_for_drop(self, ms):
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < ms:
+            try:
+                self.client.check_msg()
+            except OSError:
+                return True
+            sleep_ms(5)
+        return False
+
+    # Reconnect ourselves and listen until every prop is back
+    def wait_for_props(self, ms):
+        while ticks_diff(ticks_ms(), self.restart_at) < ms:
+            if len(self.healthy) == len(self.reconnects):
+                return True
+            try:
+                if self.client is None:
+                    self.connect()
+                self.client.check_msg()
+            except OSError:
+                self.client = None
+                sleep_ms(100)
+            sleep_ms(5)
+        return False
+
+
+def main(argv):
+    here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+    opts = {
+        "--code": here + "/../Five Runes/Code",
+        "--broker": "127.0.0.1:1883",
+        "--topic": "MI/PRODIGY/PUZZLE/#",
+        "--learn": "25",
+        "--restart": None,
+        "--timeout": "120",
+        "--json": None,
+    }
+    for i in range(1, len(argv), 2):
+        if argv[i] not in opts or i + 1 >= len(argv):
+            print("recovery: unknown option or missing value, see the top of recovery.py")
+            return 1
+        opts[argv[i]] = argv[i + 1]
+
+    sys.path.insert(0, opts["--code"])
+    from libs.simple_mqtt import MQTTClient
+
+    host, _, port = opts["--broker"].partition(":")
+    r = Recovery(MQTTClient, host, int(port or 1883), opts["--topic"])
+    r.connect()
+    r.listen(int(opts["--learn"]) * 1000)
+    if not r.reconnects:
+        print("recovery: no heartbeats seen, nothing to measure")
+        return 1
+    print(f"recovery: watching {len(r.reconnects)} props")
+
+    timeout_ms = int(opts["--timeout"]) * 1000
+    if opts["--restart"]:
+        import subprocess
+
+        r.restart_at = ticks_ms()
+        subprocess.run(opts["--restart"], shell=True, check=True)
+        r.client = None
+    else:
+        print("recovery: waiting for the broker to restart")
+        if not r.wait_for_drop(timeout_ms):
+            print("recovery: the broker didn't go away")
+            return 1
+        r.restart_at = ticks_ms()
+        r.client = None
+    done = r.wait_for_props(timeout_ms)
+
+    times = sorted(r.healthy.values())
+    report = {
+        "props": len(r.reconnects),
+        "healthy": len(r.healthy),
+        "all_healthy_ms": times[-1] if done and times else None,
+        "first_ms": times[0] if times else None,
+        "median_ms": times[len(times) // 2] if times else None,
+        "per_prop": r.healthy,
+        "missing": [p for p in r.reconnects if p not in r.healthy],
+    }
+    if opts["--json"]:
+        with open(opts["--json"], "w") as f:
+            json.dump(report, f)
+    print(json.dumps(report))
+    return 0 if done else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,164 @@
+# Just enough of the MicroPython modules used by libs/simple_mqtt.py to run
+# it under CPython. Under MicroPython (e.g. the unix port) the real modules
+# are there already and nothing is replaced.
+import sys
+import time
+
+MICROPYTHON = sys.implementation.name == "micropython"
+
+
+# socket with the MicroPython stream methods: read(n)/readinto(buf) block
+# until they have n bytes (or len(buf)), or return None when non-blocking
+# and nothing has arrived
+class _StreamSocket:
+    def __init__(self, *args):
+        import socket
+
+        self.s = socket.socket(*args)
+        self.blocking = True
+
+    # the W5500 sends each write as it comes, rather than holding small
+    # ones back as Nagle's algorithm would here
+    def connect(self, addr):
+        import socket
+
+        self.s.connect(addr)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def setblocking(self, flag):
+        self.blocking = flag
+        self.s.setblocking(flag)
+
+    def settimeout(self, t):
+        self.blocking = t != 0
+        self.s.settimeout(t)
+
+    def close(self):
+        self.s.close()
+
+    def write(self, buf, n=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self.s.sendall(buf)
+        return len(buf)
+
+    def read(self, n):
+        buf = bytearray(n)
+        n = self.readinto(buf)
+        return None if n is None else bytes(buf[:n])
+
+    def readinto(self, buf, n=None):
+        mv = memoryview(buf)
+        if n is not None:
+            mv = mv[:n]
+        if not self.blocking:
+            try:
+                return self.s.recv_into(mv)
+            except BlockingIOError:
+                return None
+        got = 0
+        while got < len(mv):
+            k = self.s.recv_into(mv[got:])
+            if not k:
+                break
+            got += k
+        return got
+
+
+def install():
+    if MICROPYTHON:
+        return
+    import types
+    import socket
+    import struct
+    import binascii
+
+    usocket = types.ModuleType("usocket")
+    usocket.socket = _StreamSocket
+    usocket.getaddrinfo = socket.getaddrinfo
+    usocket.SOCK_STREAM = socket.SOCK_STREAM
+    sys.modules.setdefault("usocket", usocket)
+    sys.modules.setdefault("ustruct", struct)
+    sys.modules.setdefault("ubinascii", binascii)
+
+    # ticks wrap at 2**30 like on the board, so ticks_diff gets exercised
+    t0 = time.monotonic()
+    period = 1 << 30
+
+    def ticks_diff(a, b):
+        return ((a - b + period // 2) % period) - period // 2
+
+    time.ticks_ms = lambda: int((time.monotonic() - t0) * 1000) % period
+    time.ticks_us = lambda: int((time.monotonic() - t0) * 1000000) % period
+    time.ticks_add = lambda a, b: (a + b) % period
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+class _Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+
+    def __init__(self, *args, **kwargs):
+        self.v = kwargs.get("value", 0)
+
+    def value(self, v=None):
+        if v is None:
+            return self.v
+        self.v = v
+
+    def on(self):
+        self.v = 1
+
+    def off(self):
+        self.v = 0
+
+    def toggle(self):
+        self.v ^= 1
+
+
+class _SPI:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+# A W5500 that is always up, on loopback
+class _WIZNET5K:
+    def __init__(self, *args):
+        self.config = ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    def active(self, flag=None):
+        return True
+
+    def isconnected(self):
+        return True
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return self.config
+        if config != "dhcp":
+            self.config = tuple(config)
+
+
+# Stand-ins for the board modules libs/miNetwork.py needs on top of
+# install()'s, so MINetwork can be driven against a loopback broker. CPython
+# only: the unix port has no SPI or W5500 to pretend with.
+def install_board():
+    install()
+    import types
+    import gc
+
+    machine = types.ModuleType("machine")
+    machine.Pin = _Pin
+    machine.SPI = _SPI
+    machine.SoftI2C = _SPI
+    sys.modules.setdefault("machine", machine)
+    network = types.ModuleType("network")
+    network.WIZNET5K = _WIZNET5K
+    sys.modules.setdefault("network", network)
+    if not hasattr(gc, "mem_free"):
+        gc.mem_free = lambda: 0
+        gc.mem_alloc = lambda: 0